@@ -4,10 +4,12 @@ OMILAB 2019 - Run a sequence of data conversions and Transkribus-API transaction
 """
 
 from TkbsDocument import Document
+from tkbs_instrument import recorder
 from TkbsApiClient import TranskribusClient
 from xml.etree import ElementTree
 import xml.etree.cElementTree as ET
 import json, os, sys, time, datetime, glob
+from pathlib import Path
 
 #check if dir exists, creates it if not
 def prep_dir(out_dir):
@@ -43,22 +45,16 @@ def wait_for_jobstatus(job, waitseconds, mytkbs, count=1):
 
 def upload(collection, input_folder, pageImages, pageXmls, title, author, description, mytkbs):
     try:
-        ImgObjects = {}
-        for key, value in pageImages.items():
-            ImgObjects[key] = open(os.path.join(input_folder, value), 'rb')
-        XmlObjects = {}
-        for key, value in pageXmls.items():
-            XmlObjects[key] = open(os.path.join(input_folder, value), 'rb')
-        pfiles = []
+        pfiles = [] #file paths, each file is opened by the client only while its page is sent
         jstring = '{"md": {"title": "' + title + '", "author": "' + author + '", "description": "' + description + '"}, "pageList": {"pages": ['
         psik = ', '
         for key, value in pageImages.items():
             if len(pageImages) <= int(key):
                 psik = ''
             jstring = jstring + '{"fileName": "' + value + '", "pageXmlName": "' + pageXmls[key] + '", "pageNr": ' + key + '}' + psik
-            pfiles.append({'img': (value, ImgObjects[key], 'application/octet-stream'), 'xml': (pageXmls[key], XmlObjects[key], 'application/octet-stream')})
+            pfiles.append({'img': (value, Path(input_folder, value), 'application/octet-stream'), 'xml': (pageXmls[key], Path(input_folder, pageXmls[key]), 'application/octet-stream')})
         jstring = jstring + ']}}'
-        response = mytkbs.createDocFromImages(collection, jstring, pfiles)
+        response = mytkbs.createDocFromImages(collection, jstring, pfiles, iWorkers=4)
         tree = ElementTree.fromstring(response)
         total = tree.find('nrOfPagesTotal').text
         docid = tree.find('uploadId').text
@@ -83,7 +79,7 @@ def upload(collection, input_folder, pageImages, pageXmls, title, author, descri
 
 def download(collection, documentid, folder, mytkbs, metafilename):
     try:
-        response = mytkbs.download_document(collection, documentid, folder)
+        response = mytkbs.download_document(collection, documentid, folder, iWorkers=4)
         #print(response)
         pages = len(response[1])
         if pages > 0:
@@ -184,6 +180,7 @@ HTRmodelid = "10168" #CHANGE THIS
 outfolder = r'<WORK FOLDER>\output' #CHANGE THIS
 workfolder = prep_dir(os.path.join(outfolder, 'work'))
 exportfolder = prep_dir(os.path.join(outfolder, 'export'))
+recorder.open(os.path.join(workfolder, 'stage_timings.jsonl'))
 
 subfolders = [x[0] for x in os.walk(r'<WORK FOLDER>\input')] #CHANGE THIS
 
@@ -192,13 +189,14 @@ for sfolder in subfolders:
         if not os.path.isfile(os.path.join(sfolder, 'TOC.xml')):
             continue
         infolder = sfolder 
+        recorder.start_issue(infolder)
         start = str(datetime.datetime.now().strftime("%y-%m-%d-%H-%M"))
         print(start + " - " + infolder)# + "\n==============")
 
         v and print("---   CREATING DATA to upload  ---")
         p = Document()
         #p.set_factors(150, 1.7238, 0.67)
-        p.load_legacy_data(infolder)
+        p.load_legacy_data(infolder, cachedir=os.path.join(workfolder, 'legacy_snapshots'))
         
         teifolder = os.path.join(exportfolder, 'tei')
         teifiles = glob.glob(teifolder + r'\*' + p.doc_title + r'*_tei.xml')
@@ -214,19 +212,19 @@ for sfolder in subfolders:
         
         
         v and print("---   UPLOADING data to server       ---")
-        docid = upload(collec, firstexportdir, p.img_names_by_pgnum(), p.pxml_names_by_pgnum(), p.title, user, "pipeline test", tkbs)
+        with recorder.stage("upload"):
+            docid = upload(collec, firstexportdir, p.img_names_by_pgnum(), p.pxml_names_by_pgnum(), p.title, user, "pipeline test", tkbs)
         if docid <= 0:
             print ("ERROR - document failed to upload " + p.title)
             continue 
         
-        v and print("---   DOWNLOADING-1 doc for page ids       ---")
-        tempdowndir = prep_dir(os.path.join(workfolder, "tempdowndir"))
-        target_dir = os.path.join(tempdowndir, p.title + "_" + str(collec) + "_" + str(docid))
-        docjson = download(collec, str(docid), target_dir, tkbs, p.tkbs_meta_filename)
-        pageids = p.load_tkbs_page_ids(docjson)
+        v and print("---   GETTING page ids       ---")
+        with recorder.stage("get_page_ids"):
+            pageids = tkbs.getPageIds(collec, docid, bRefresh=True) #from the document metadata, nothing is downloaded
         
         v and print("---   LINE DETECTION          ---")
-        detection_status = line_detect(collec, docid, pageids, tkbs)
+        with recorder.stage("line_detection", len(pageids)):
+            detection_status = line_detect(collec, docid, pageids, tkbs)
         if not detection_status:
             print ("ERROR - document failed line detection " + p.title)
             continue 
@@ -235,30 +233,31 @@ for sfolder in subfolders:
         extentiondowndir = os.path.join(workfolder, "extentiondowndir")
         prep_dir(extentiondowndir)
         xtarget_dir = os.path.join(extentiondowndir, p.title + "_" + str(collec) + "_" + str(docid))
-        xdocjson = download(collec, str(docid), xtarget_dir, tkbs, p.tkbs_meta_filename)
+        with recorder.stage("download_baselines"):
+            xdocjson = download(collec, str(docid), xtarget_dir, tkbs, p.tkbs_meta_filename)
         xpageids = p.load_tkbs_page_ids(xdocjson)
         
         v and print("---   BASELINE EXTENTION         ---")
-        for num, fname in p.pxml_names_by_pgnum().items():
-            fullname = os.path.join(xtarget_dir, fname)
-            edit_pg_baseline(fullname, 10)
+        with recorder.stage("baseline_extension", p.page_count):
+            for num, fname in p.pxml_names_by_pgnum().items():
+                fullname = os.path.join(xtarget_dir, fname)
+                edit_pg_baseline(fullname, 10)
         
         v and print("---   UPLOAD extended baseline data to server          ---")
-        xdocid = upload(collec, xtarget_dir, p.img_names_by_pgnum(), p.pxml_names_by_pgnum(), p.title, user, "pipeline test baseline extended", tkbs)
+        with recorder.stage("upload_extended"):
+            xdocid = upload(collec, xtarget_dir, p.img_names_by_pgnum(), p.pxml_names_by_pgnum(), p.title, user, "pipeline test baseline extended", tkbs)
         if xdocid <= 0:
             print ("ERROR - document failed to upload after baseline extention" + p.title)
             continue #sys.exit(1)
         
-        v and print("---   DOWNLOADING-3 doc for ocr page ids      ---")
-        preocr = os.path.join(workfolder, "preocr")
-        prep_dir(preocr)
-        preocr_dir = os.path.join(preocr, p.title + "_" + str(collec) + "_" + str(xdocid))
-        pdocjson = download(collec, str(xdocid), preocr_dir, tkbs, p.tkbs_meta_filename)
-        ppageids = p.load_tkbs_page_ids(pdocjson)
+        v and print("---   GETTING page ids for ocr      ---")
+        with recorder.stage("get_ocr_page_ids"):
+            ppageids = tkbs.getPageIds(collec, xdocid, bRefresh=True)
         
         
         v and print("---   RUNNING OCR          ---")
-        ocr_status = run_ocr(collec, HTRmodelid, "", str(xdocid), ppageids, tkbs)
+        with recorder.stage("ocr", len(ppageids)):
+            ocr_status = run_ocr(collec, HTRmodelid, "", str(xdocid), ppageids, tkbs)
         if not ocr_status:
             print ("ERROR - document failed ocr " + p.title)
             continue #sys.exit(1)
@@ -267,7 +266,8 @@ for sfolder in subfolders:
         ocrdowndir = os.path.join(exportfolder, "transkribus")
         prep_dir(ocrdowndir)
         otarget_dir = os.path.join(ocrdowndir, p.title + "_" + str(collec) + "_" + str(xdocid))
-        ocrdocjson = download(collec, str(xdocid), otarget_dir, tkbs, p.tkbs_meta_filename)
+        with recorder.stage("download"):
+            ocrdocjson = download(collec, str(xdocid), otarget_dir, tkbs, p.tkbs_meta_filename)
         pageids = p.load_tkbs_page_ids(ocrdocjson)
         
         
@@ -299,7 +299,10 @@ for sfolder in subfolders:
         print (e)
         print ("END ERROR \n\n")
         pass
+    finally:
+        recorder.end_issue()
 
 
 
 tkbs.auth_logout()
+tkbs.close()
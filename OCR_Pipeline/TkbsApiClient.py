@@ -41,12 +41,18 @@ import sys
 import os
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 from io import open
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+import io
 import json
+import uuid
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pickle 
 
@@ -74,6 +80,92 @@ def getStoredCredentials(bAsk=False):
         raise ValueError("Missing Transkribus credentials!")
     return login, pwd
         
+class MultipartStream(object):
+    """
+    multipart/form-data request body read by chunks, files of any size are sent with constant memory
+    
+    dFields is {name: value}, value being a string (plain form field) or a (file name, file[, content type]) tuple
+    the file is a path given as an os.PathLike (e.g. pathlib.Path), inline content (bytes, or a string sent utf-8 encoded) 
+    or a binary file object
+    a path is opened when the body reaches it and closed at its end, a file object is read from its start
+    fnProgress, if given, is called with the number of bytes of each chunk read by the connection
+    
+    Send it as data= with a Content-Type header of sContentType, requests then sets the Content-Length 
+    and reads the body by chunks
+    """
+    def __init__(self, dFields, fnProgress=None):
+        self.sBoundary = uuid.uuid4().hex
+        self.sContentType = "multipart/form-data; boundary=%s"%self.sBoundary
+        self._fnProgress = fnProgress
+        self._lSegments = []    # in body order: bytes, or (file, size) of a file field
+        for sName, value in dFields.items():
+            if isinstance(value, tuple):
+                sFileName, oFile = value[0], value[1]
+                if isinstance(oFile, str): oFile = oFile.encode(utf8)
+                sType = value[2] if len(value) > 2 and value[2] else "application/octet-stream"
+                sHeader = '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n\r\n'%(self.sBoundary, sName, sFileName, sType)
+                self._lSegments.append(sHeader.encode(utf8))
+                self._lSegments.append((oFile, self._fileSize(oFile)))
+                self._lSegments.append(b"\r\n")
+            else:
+                sField = '--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'%(self.sBoundary, sName, value)
+                self._lSegments.append(sField.encode(utf8))
+        self._lSegments.append(("--%s--\r\n"%self.sBoundary).encode(utf8))
+        self.len = sum(len(segment) if isinstance(segment, bytes) else segment[1] for segment in self._lSegments)
+        self._iSegment, self._iOffset = 0, 0    # read position
+        self._oFile, self._bOwnFile = None, False
+
+    def __len__(self):
+        return self.len
+
+    def _fileSize(self, oFile):
+        if isinstance(oFile, os.PathLike): return os.path.getsize(oFile)
+        if isinstance(oFile, bytes): return len(oFile)
+        oFile.seek(0, 2)
+        iSize = oFile.tell()
+        oFile.seek(0)
+        return iSize
+
+    def _openFile(self, oFile):
+        if isinstance(oFile, os.PathLike):
+            self._oFile, self._bOwnFile = open(os.fspath(oFile), 'rb'), True
+        elif isinstance(oFile, bytes):
+            self._oFile, self._bOwnFile = io.BytesIO(oFile), True
+        else:
+            oFile.seek(0)
+            self._oFile, self._bOwnFile = oFile, False
+
+    def read(self, size=-1):
+        if size is None or size < 0: size = self.len
+        lChunks, iLeft = [], size
+        while iLeft > 0 and self._iSegment < len(self._lSegments):
+            segment = self._lSegments[self._iSegment]
+            if isinstance(segment, bytes):
+                chunk = segment[self._iOffset:self._iOffset + iLeft]
+                iSize = len(segment)
+            else:
+                if self._oFile is None: self._openFile(segment[0])
+                iSize = segment[1]
+                chunk = self._oFile.read(min(iLeft, iSize - self._iOffset))
+                if not chunk: raise IOError("%s is shorter than when the upload started"%segment[0])
+            lChunks.append(chunk)
+            iLeft -= len(chunk)
+            self._iOffset += len(chunk)
+            if self._iOffset >= iSize:
+                self.close()
+                self._iSegment, self._iOffset = self._iSegment + 1, 0
+        data = b"".join(lChunks)
+        if data and self._fnProgress: self._fnProgress(len(data))
+        return data
+
+    def close(self):
+        """
+        close the file being read, if it was opened here
+        """
+        if self._oFile is not None and self._bOwnFile: self._oFile.close()
+        self._oFile, self._bOwnFile = None, False
+
+
 class TranskribusClient():
     """
     
@@ -126,9 +218,21 @@ class TranskribusClient():
     #--- --- INIT --- -------------------------------------------------------------------------------------------------------------    
     def __init__(self, sServerUrl='https://transkribus.eu/TrpServerTesting'#"https://transkribus.eu/TrpServer"#
                  , proxies={}
-                 , loggingLevel=logging.WARN):
+                 , loggingLevel=logging.WARN
+                 , iPoolSize=10
+                 , bKeepAlive=True
+                 , fPageIdsTtl=60):
+        """
+        iPoolSize is the number of connections kept open to the server, use at least the number of threads sharing the client
+        bKeepAlive=False closes the connection after every request
+        fPageIdsTtl is how many seconds getPageIds answers from its cache before checking the document metadata again
+        """
         self._sessionID = None  # if logged in, id of the session, None otherwise
         self._dProxies  = {}    # proxy settings
+        self._httpSession = self._newHttpSession(iPoolSize, bKeepAlive) # pooled connections, shared by all requests of this client
+        self._dPageIds = {}     # key: (colId, docId), value: ({page number: page id}, time read), see getPageIds
+        self._pageIdsLock = threading.Lock()
+        self._fPageIdsTtl = fPageIdsTtl
 
         self.sServerUrl= sServerUrl
         # Raise or lower this setting according to the amount of debugging
@@ -214,6 +318,20 @@ class TranskribusClient():
 
         return True  
 
+    def close(self):
+        """
+        Close the pooled connections to the server, the session token is kept (see auth_logout)
+        The client can still be used afterwards, new connections are then opened
+        """
+        self._httpSession.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
     def auth_logout(self):
         """
         Logout from the server, remove any persistent session token from disk
@@ -300,7 +418,24 @@ class TranskribusClient():
     
 #    def detectLines(self, collId, doc)
     
-    def createDocFromImages(self, collection, structure_json, body_parts):
+    def createDocFromImages(self, collection, structure_json, body_parts, iWorkers=1, iRetries=2, fnProgress=None):
+        """
+        Create a document from page images and PAGE XML files with an upload process
+        
+        structure_json describes the pages, body_parts holds one {'img': (name, file, type), 'xml': (name, file, type)} per page
+        a file given as a path (os.PathLike, e.g. pathlib.Path) is opened when its part is sent and closed right after, 
+        so no file stays open meanwhile; a str or bytes file is sent as its content
+        iWorkers > 1 sends up to iWorkers parts at a time
+        a part that fails, or whose page is not reported as uploaded, is sent again, up to iRetries times
+        files are streamed from disk by chunks, fnProgress(number of bytes) is called for every chunk sent, from the worker threads
+        
+        Return the upload status XML (text), its pageUploaded flags are those reported for each part, 
+        the jobId is there once every page is uploaded. Raise the last error if a part still fails.
+        
+        A part is matched to its page of the upload status by the pageNr structure_json gives its image 
+        (else its position in body_parts, from 1), then by file name. When the status does not list its page, 
+        the successful PUT alone marks the part uploaded.
+        """
         self._assertLoggedIn()
         myReq = self.sREQ_collection_uploadProc
         params = self._buidlParamsDic(collId=collection)
@@ -309,10 +444,36 @@ class TranskribusClient():
         resultTag  = self._xmlParse__xpathEval_getContent(resp.text, "//uploadId")
         uploadId = resultTag[0].text
         upReq = self.sREQ_collection_uploadProc + '/' + uploadId 
-        for part in body_parts:
-            upresp = self._PUT(upReq, pagefiles=part)
-            upresp.raise_for_status()
-        return upresp.text
+        
+        dPageNr = self._uploadPageNumbers(structure_json, body_parts)
+        dUploaded = {}      # key: page number, value: True once the page is uploaded
+        dError = {}         # key: page number, value: error of its last PUT
+        lStatus = [resp.text]   # upload status XML of the upload process creation and of every successful PUT
+        lPending = list(range(len(body_parts)))
+        for iTry in range(iRetries + 1):
+            if iWorkers > 1:
+                with ThreadPoolExecutor(max_workers=iWorkers) as executor:
+                    lResults = list(executor.map(lambda i: self._putPart(upReq, body_parts[i], fnProgress), lPending))
+            else:
+                lResults = [self._putPart(upReq, body_parts[i], fnProgress) for i in lPending]
+            lFailed = []
+            for i, (sStatus, error) in zip(lPending, lResults):
+                iPageNr = dPageNr[i]
+                sFileName = body_parts[i]['img'][0]
+                if error is None:
+                    lStatus.append(sStatus)
+                    dUploaded[iPageNr] = self._isPageUploaded(sStatus, iPageNr, sFileName)
+                    dError.pop(iPageNr, None)
+                else:
+                    dError[iPageNr] = error
+                if not dUploaded.get(iPageNr):
+                    lFailed.append(i)
+                    logging.warning("page %d (%s) not uploaded (attempt %d of %d)"%(iPageNr, sFileName, iTry + 1, iRetries + 1))
+            lPending = lFailed
+            if not lPending: break
+        
+        if dError: raise list(dError.values())[-1]
+        return self._mergeUploadStatus(lStatus, dUploaded, dict((part['img'][0], dPageNr[i]) for i, part in enumerate(body_parts)))
 
         
     
@@ -325,6 +486,7 @@ class TranskribusClient():
         myReq = self.sREQ_collection_collection%(colId, docId)
         resp = self._DELETE(myReq, { 'collId':colId, 'id':docId })
         resp.raise_for_status()
+        self._forgetPageIds(colId, docId)
         return resp
  
 
@@ -345,6 +507,40 @@ class TranskribusClient():
         return json.loads(resp.text)
 
 
+    def getPageIds(self, colId, docId, trp=None, bRefresh=False):
+        """
+        Convenience method, not provided directly by the Transkribus API.
+        
+        Return {page number: page id} of the colId, docId document, from its metadata only: no image or PAGE XML is downloaded.
+        
+        Page ids are cached by (colId, docId) with the time they were read.
+        download_document and getPageIds fill the cache. A document cached less than fPageIdsTtl seconds ago 
+        is answered without any request, after that its metadata (one transcript per page) is fetched again 
+        and its ids always replace the cached ones, no timestamp is compared.
+        trp is document metadata already at hand (getDocById result or trp.json of a download), 
+        its ids replace the cached ones.
+        bRefresh=True fetches the metadata even for a recently cached document, e.g. right after an upload.
+        deleteDocument and the layout analysis and HTR job requests drop the cached ids of their document.
+        """
+        key = (str(colId), str(docId))
+        with self._pageIdsLock:
+            cached = self._dPageIds.get(key)
+        if trp is None:
+            if cached is not None and not bRefresh and time.time() - cached[1] < self._fPageIdsTtl:
+                return dict(cached[0])
+            trp = self.getDocById(colId, docId, nrOfTranscripts=1)
+        ids = dict((page['pageNr'], page['pageId']) for page in trp["pageList"]["pages"])
+        with self._pageIdsLock:
+            self._dPageIds[key] = (ids, time.time())
+        return dict(ids)
+
+    def _forgetPageIds(self, colId, docId):
+        """
+        drop the cached page ids of the colId, docId document, see getPageIds
+        """
+        with self._pageIdsLock:
+            self._dPageIds.pop((str(colId), str(docId)), None)
+
     def getDocByIdAsXml(self, colId, docId, nrOfTranscripts=None, bParse=True):
         """
         Return the Transkribus data structure (either parsed as a DOM or as a serialized XML, , i.e. a unicode string)
@@ -594,7 +790,8 @@ class TranskribusClient():
         return coll_max_ts, ldocID, dLFileList
         
 
-    def download_document(self, colId, docId, docDir, min_ts=-1, bForce=False, bOverwrite=False, bNoImage=False, trp_spec=None):        
+    def download_document(self, colId, docId, docDir, min_ts=-1, bForce=False, bOverwrite=False, bNoImage=False, trp_spec=None
+                          , iWorkers=1, iChunkSize=1024*1024):        
         """
         Convenience method, not provided directly by the Transkribus API.
         
@@ -607,7 +804,11 @@ class TranskribusClient():
             - if bOverwrite is True, overwrite whatever is conflicting
             - otehrwise raise an Exception 
         
-        Return the maximum timestamp over all pages of the document.
+        iWorkers > 1 transfers up to iWorkers files (page images and page XML) at a time
+        images are streamed to disk by chunks of iChunkSize bytes
+        every file is written to a temporary file first and renamed, a failed transfer leaves no partial file and raises
+        
+        Return the maximum timestamp over all pages of the document, and the list of the page base names.
         """
         if trp_spec:
             logging.info("- downloading collection %s, document %s  into folder %s    (bForce=%s) as specified by trp"%(colId, docId, docDir, bForce))
@@ -627,6 +828,7 @@ class TranskribusClient():
             
         pageList = trp["pageList"]
         doc_max_ts = max( [page['tsList']["transcripts"][0]['timestamp'] for page in pageList['pages'] ] )
+        self.getPageIds(colId, docId, trp) # cached for the callers of getPageIds
 
         if doc_max_ts <= min_ts:
             #no need to download
@@ -659,6 +861,7 @@ class TranskribusClient():
 
         
         lFileList= []
+        lTransfers = [] # (url, destination file, True for a streamed image)
         for page in pageList['pages']:
             pagenum= page['pageNr']
             logging.info("\t\t- page %s"%pagenum)
@@ -671,27 +874,51 @@ class TranskribusClient():
             
             #Now store the image and pageXml
             if not bNoImage:
-                destImgFilename = docDir + os.sep + imgFileName
-                logging.info("\t\t\t%s"%destImgFilename)
-                resp = self._GET(urlImage, stream=True)
-                with open(destImgFilename, 'wb') as fd:
-                    for chunk in resp.iter_content(10240):
-                        fd.write(chunk)                
+                lTransfers.append((urlImage, docDir + os.sep + imgFileName, True))
             sBaseName, _ = os.path.splitext(imgFileName)
-            destXmlFilename = docDir + os.sep + sBaseName + ".pxml"
-            logging.info("\t\t\t%s"%destXmlFilename)
-            resp = self._GET(urlXml)
-            savefile=open(destXmlFilename,'wt',encoding='utf-8')
-            savefile.write(resp.text)  
-            savefile.close()  
+            lTransfers.append((urlXml, docDir + os.sep + sBaseName + ".pxml", False))
 #             trace('.')
 #             flush()
+        if iWorkers > 1:
+            with ThreadPoolExecutor(max_workers=iWorkers) as executor:
+                #list() waits for every transfer and raises the first error
+                list(executor.map(lambda transfer: self._downloadFile(transfer[0], transfer[1], transfer[2], iChunkSize), lTransfers))
+        else:
+            for url, destFilename, bImage in lTransfers:
+                self._downloadFile(url, destFilename, bImage, iChunkSize)
         with open(docDir+os.sep+"max.ts", "w") as fd: fd.write("%s"%doc_max_ts) 
 
         logging.info("- DONE (downloaded collection %s, document %s into folder %s    (bForce=%s))"%(colId, docId, docDir, bForce))
         return doc_max_ts, lFileList
 
 
+    def _downloadFile(self, url, destFilename, bImage, iChunkSize):
+        """
+        store url in destFilename through a temporary file renamed once complete
+        an image is streamed by chunks of iChunkSize bytes, a page XML is stored as UTF-8 text
+        """
+        logging.info("\t\t\t%s"%destFilename)
+        sTmpFilename = "%s.%s.part"%(destFilename, threading.current_thread().ident)
+        try:
+            if bImage:
+                resp = self._GET(url, stream=True)
+                try:
+                    resp.raise_for_status()
+                    with open(sTmpFilename, 'wb') as fd:
+                        for chunk in resp.iter_content(iChunkSize):
+                            fd.write(chunk)
+                finally:
+                    resp.close()
+            else:
+                resp = self._GET(url)
+                resp.raise_for_status()
+                with open(sTmpFilename, 'wt', encoding='utf-8') as fd:
+                    fd.write(resp.text)
+            os.replace(sTmpFilename, destFilename)
+        except:
+            if os.path.exists(sTmpFilename): os.unlink(sTmpFilename)
+            raise
+
     def getListofLockedPages(self, colid, docid, page):
         """    
         return the list of locks for colid/docid/page
@@ -787,6 +1014,7 @@ class TranskribusClient():
         params = self._buidlParamsDic(collId=colId, id=docId, pages=sPages, doBlockSeg=bBlockSeg, doLineSeq=bLineSeg)
         resp = self._POST(myReq, params=params, sContentType=None)
         resp.raise_for_status()
+        self._forgetPageIds(colId, docId)
         return resp.text       
 
     def analyzeLayout(self,colId, docPagesJson, bBlockSeg, bLineSeg):
@@ -804,6 +1032,12 @@ class TranskribusClient():
         params = self._buidlParamsDic(collId=colId, doBlockSeg=bBlockSeg, doLineSeq=bLineSeg)
         resp = self._POST(myReq, params=params, data=docPagesJson, sContentType='application/json')
         resp.raise_for_status()
+        try:
+            for doc in json.loads(docPagesJson)["docList"]["docs"]:
+                self._forgetPageIds(colId, doc["docId"])
+        except (ValueError, KeyError, TypeError):
+            with self._pageIdsLock:
+                self._dPageIds.clear()
         return resp.text       
 
 
@@ -859,6 +1093,7 @@ class TranskribusClient():
         params = self._buidlParamsDic(id=docId)
         resp = self._POST(myReq, params=params)
         resp.raise_for_status()
+        self._forgetPageIds(colId, docId)
         return resp.text
 
     # ---
@@ -963,6 +1198,7 @@ class TranskribusClient():
 
         resp = self._POST(myReq, params=params,data=postparams ,  sContentType = "application/json")
         resp.raise_for_status()
+        self._forgetPageIds(colId, docId)
         return resp.text
 
     
@@ -1128,6 +1364,19 @@ doBlockSeg=false
     
     # --- HTTP Utilities --- ------------------------------------------------------------------
     
+    def _newHttpSession(self, iPoolSize, bKeepAlive):
+        """
+        requests session with a connection pool of iPoolSize connections per host
+        the pool is thread-safe, threads block while all its connections are in use
+        the session ID is sent in the Cookie header of every request, it takes precedence over cookies stored by the session
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=iPoolSize, pool_maxsize=iPoolSize, pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not bKeepAlive: session.headers['Connection'] = 'close'
+        return session
+
     def setProxies(self, proxies):
         """
         Proxies
@@ -1166,41 +1415,116 @@ doBlockSeg=false
         dHeader = {'Cookie':'JSESSIONID=%s'%self._sessionID}
         if sContentType: dHeader['Content-Type'] = sContentType
             
-        return requests.post(sRequest, params=params, headers=dHeader
+        return self._httpSession.post(sRequest, params=params, headers=dHeader
                              , proxies=self._dProxies, data=data, verify=False)        
 
-    def _POSTfiles(self, sRequest, params={}, data={}, files={}, sContentType = "application/xml"):
+    def _POSTfiles(self, sRequest, params={}, data={}, files={}, sContentType = "application/xml", fnProgress=None):
         """
         if you set sContentType to None or "", nothing is specified in the request header
+        with files, the data fields and the files are streamed as a multipart body (see MultipartStream), with its own content type
         """
         dHeader = {'Cookie':'JSESSIONID=%s'%self._sessionID}
         if sContentType: dHeader['Content-Type'] = sContentType
-            
-        return requests.post(sRequest, params=params, headers=dHeader
-                             , proxies=self._dProxies, data=data, files=files, verify=False)        
+        if not files:
+            return self._httpSession.post(sRequest, params=params, headers=dHeader
+                                 , proxies=self._dProxies, data=data, verify=False)        
+        dFields = dict(data)
+        dFields.update(files)
+        body = MultipartStream(dFields, fnProgress)
+        dHeader['Content-Type'] = body.sContentType
+        try:
+            return self._httpSession.post(sRequest, params=params, headers=dHeader
+                                 , proxies=self._dProxies, data=body, verify=False)        
+        finally:
+            body.close()
 
     def _DELETE(self, sRequest, params={}, data={}):
-        return requests.delete(sRequest, params=params, headers={'Cookie':'JSESSIONID=%s'%self._sessionID}
+        return self._httpSession.delete(sRequest, params=params, headers={'Cookie':'JSESSIONID=%s'%self._sessionID}
                                , proxies=self._dProxies, data=data, verify=False)        
         
     def _GET(self, sRequest, params={}, stream=None, accept="application/xml"):
         if stream == None: #not sure what is the default value...
-            return requests.get(sRequest, params=params, headers={'Cookie':'JSESSIONID=%s'%self._sessionID, 'Accept':accept}
+            return self._httpSession.get(sRequest, params=params, headers={'Cookie':'JSESSIONID=%s'%self._sessionID, 'Accept':accept}
                                 , proxies=self._dProxies, verify=False)
         else:
-            return requests.get(sRequest, params=params, headers={'Cookie':'JSESSIONID=%s'%self._sessionID, 'Accept':accept}
+            return self._httpSession.get(sRequest, params=params, headers={'Cookie':'JSESSIONID=%s'%self._sessionID, 'Accept':accept}
                                 , proxies=self._dProxies, verify=False, stream=stream)
             
-    def _PUT(self, sRequest, params={}, pagefiles={}):
+    def _PUT(self, sRequest, params={}, pagefiles={}, fnProgress=None):
         """
-        if you set sContentType to None or "", nothing is specified in the request header
+        pagefiles are streamed from disk as a multipart body, see MultipartStream
         """
-        dHeader = {'Cookie':'JSESSIONID=%s'%self._sessionID}
-        #if sContentType: dHeader['Content-Type'] = sContentType
-            
-        return requests.put(sRequest, params=params, headers=dHeader, proxies=self._dProxies, files=pagefiles, verify=False)        
+        body = MultipartStream(pagefiles, fnProgress)
+        dHeader = {'Cookie':'JSESSIONID=%s'%self._sessionID, 'Content-Type':body.sContentType}
+        try:
+            return self._httpSession.put(sRequest, params=params, headers=dHeader, proxies=self._dProxies, data=body, verify=False)        
+        finally:
+            body.close()
         
 
+    def _putPart(self, upReq, part, fnProgress=None):
+        """
+        PUT one page part of an upload process, files given as an os.PathLike are opened only while they are sent
+        return (upload status XML, None) or (None, the exception)
+        """
+        try:
+            upresp = self._PUT(upReq, pagefiles=part, fnProgress=fnProgress)
+            upresp.raise_for_status()
+            return upresp.text, None
+        except Exception as e:
+            return None, e
+
+    def _uploadPageNumbers(self, structure_json, body_parts):
+        """
+        {part index: page number} of the body_parts of an upload: the pageNr structure_json gives the image of the part, 
+        else the position of the part, from 1
+        """
+        dByName = {}
+        try:
+            for page in json.loads(structure_json)["pageList"]["pages"]:
+                dByName[page["fileName"]] = int(page["pageNr"])
+        except (ValueError, KeyError, TypeError):
+            pass
+        return dict((i, dByName.get(part['img'][0], i + 1)) for i, part in enumerate(body_parts))
+
+    def _findUploadPage(self, status, iPageNr, sFileName):
+        """
+        the pages element of the upload status DOM for page iPageNr, else for image sFileName, else None
+        """
+        lPages = list(status.iter("pages"))
+        for page in lPages:
+            if page.findtext("pageNr") == str(iPageNr):
+                return page
+        for page in lPages:
+            if page.findtext("pageNr") is None and page.findtext("fileName") == sFileName:
+                return page
+        return None
+
+    def _isPageUploaded(self, sStatus, iPageNr, sFileName):
+        """
+        True if the upload status XML reports page iPageNr (image sFileName) as uploaded, 
+        or does not list it: the PUT that returned sStatus succeeded
+        """
+        page = self._findUploadPage(self._xmlParseDoc(sStatus), iPageNr, sFileName)
+        if page is None or page.find("pageUploaded") is None:
+            return True
+        return page.findtext("pageUploaded") == "true"
+
+    def _mergeUploadStatus(self, lStatus, dUploaded, dPageByName):
+        """
+        the latest upload status with a jobId (else the latest one), its pageUploaded flags set from the reports of each part
+        a page of the status is found by its pageNr, or by its fileName through dPageByName {image file name: page number}
+        """
+        lWithJob = [sStatus for sStatus in lStatus if self._xmlParse__xpathEval_getContent(sStatus, "//jobId")]
+        status = self._xmlParseDoc((lWithJob or lStatus)[-1])
+        for page in status.iter("pages"):
+            nd = page.find("pageUploaded")
+            sPageNr = page.findtext("pageNr")
+            iPageNr = int(sPageNr) if sPageNr is not None and sPageNr.isdigit() else dPageByName.get(page.findtext("fileName"))
+            if nd is not None and iPageNr in dUploaded:
+                nd.text = "true" if dUploaded[iPageNr] else "false"
+        return etree.tostring(status, encoding="unicode")
+
     def _buidlParamsDic(self, **kwargs):
         """
         self._buidlParamsDic(a=None, b=2, c=3, d=None)  --> {'c': 3, 'b': 2}
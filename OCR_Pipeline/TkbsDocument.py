@@ -7,10 +7,26 @@ Convert Olive Legacy historical press Document format to Transkribus page-xml fo
 """
 
 from lxml import etree
-from shutil import copyfile
-import os, sys, json, csv, mmap
+from shutil import copyfile, copyfileobj
+import os, sys, json, csv, mmap, time, gc
 import xml.etree.ElementTree as ET
-import zipfile
+import zipfile, pickle, hashlib, sqlite3
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from tkbs_instrument import recorder, timed_stage
+try:
+    import fcntl #reflink staging, not available on Windows
+except ImportError:
+    fcntl = None
+try:
+    import resource #memory budget and peak RSS, not available on Windows
+except ImportError:
+    resource = None
+
+LEGACY_SNAPSHOT_VERSION = 5 #bump when the parsed legacy state changes, older snapshots are then ignored
+ISSUE_INDEX_VERSION = 2 #bump when the issue index layout changes
+LEGACY_INDEX_VERSION = 2 #bump when the legacy_index tables change, an older index is then rebuilt
+PIPELINE_OUTPUT_DIRS = ["legacy_output", "legacy_snapshots", "transkribus_output", "transkribus_export"] #written next to the issues by the pipeline scripts
 
 
 class Document:
@@ -23,14 +39,17 @@ class Document:
         self.docdir = "Document"
         self.legacydir = None
         self.tkbs_exportdir = None
+        self.legacy_source = None #legacy_source of the Document folder or Document.zip, set by load_legacy_data
         self.page_count = 0
         self.PagesImgResolutions = {} #key: page num, value: image resolution, from Pgxxx.xml
         self.PagesImgName = {} #key: page num, value: image filename, from TOC.xml
-        self.PagesResolutionFactor = {} #key: page num, value: 1 or max_res / page_res
+        self.PagesResolutionFactor = {} #key: page num, value: 1 or image_res / page_res
+        self.PagesImgVariant = {} #key: page num, value: resolution of the chosen page image, from the Img folder listing
         self.PagesXmlName = {} #key: page num, value: Pg00x.xml filename, from TOC.xml
         self.EntitiesIndex = {} #key: Entity name, from TOC.xml, value:   entity TOC_ENTRY_ID
         self.EntitiesPage = {} #key: Entity name, value: entity PAGE_NO , from TOC.xml
         self.article_types = {} #key: Article Id, value: AR or AD, from TOC.xml
+        self.toc = None #legacy_toc model of TOC.xml, parsed once and shared by all loaders
         self.input_pub_file_name = ""
         self.xmlcode = "UTF-8"
         self.cut_low_line_part = 0.33 #remove the lower part of the line box to help TKBS identify the baseline
@@ -38,8 +57,14 @@ class Document:
         self.frame_primitive_type = 'AdFrame'
         self.graphic_primitive_type = 'Picture'
         self.inputdir_images = 'Img'
+        self.image_staging = "copy" #how page images are put in the export folder: hardlink, reflink, symlink or copy
+        self.image_staging_fallback = {"hardlink": ["hardlink", "reflink", "copy"], "reflink": ["reflink", "copy"],
+                                       "symlink": ["symlink", "copy"], "copy": ["copy"]} #strategies tried in order
+        self.image_copy_workers = 4 #images staged in parallel
+        self.PagesImgStaging = {} #key: page num, value: strategy that staged the page image in the last export
         self.outputdir_xmls = 'page'
         self.legacy_garbage_width = 13
+        self.probe_chunk_size = 4096 #bytes fed to the parser at a time when probing Pgxxx.xml Meta
         self.max_doc_resolution = None
         self.factor1 = None
         self.factor2 = None
@@ -48,12 +73,15 @@ class Document:
         self.pxmlOutname = {}
         self.PagesImgHeight = {} #key: page num, value: image height, from Pgxxx.xml
         self.PagesImgWidth = {} #key: page num, value: image width, from Pgxxx.xml
-        self.ContentPrimitives = [] # list of content primitives , from Pgxxx.xml
+        self.ContentPrimitives = set() # set of content primitives , from Pgxxx.xml
         self.PrimitivesIndexInPage = {} #key: prim calculated index from SEQ_NUM, value: Primitive Name, from Arxxx.xml
         self.RegionBoxing = {} #key: primitive id-name, value: primitive box converted to transkribus format, from Arxxx.xml
         self.LineBoxing = {} #key: lineId primitive_count, value: line box converted to transkribus format, from Arxxx.xml
         self.LineIndexInRegion = {} #key: lineId primitive_count, value: count
         self.PrimitiveTypes = {} #key: primitive id-name, value: primitive type from ELEMENT_TYPE Pgxxx.xml
+        self.PagesPlan = None #key: page num, value: list of (primitive id-name, region type) in reading order
+        self.PagesPrimitives = {} #key: page num, value: list of the page primitive id-names registered in PrimitivesIndexInPage
+        self.EntityPrimitives = {} #key: entity id (primitive id without 2 last chars), value: list of its primitive id-names, in PrimitivesIndexInPage order
         self.tkbs_meta_filename = "trp.json"
         self.tkbs_xml_schema = "http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15"
         self.tkbs_xsd = "http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15/pagecontent.xsd"
@@ -68,6 +96,15 @@ class Document:
         self.articles = {}
         self.legacy_articles = {}
         self.HeaderPrimitives = [] #key: entity id, value: bool true if entity has HeadLine_hl1 primitive
+        self.sourcefile = None #TOC.xml the legacy articles were read from
+        self.errors = [] #exceptions caught while loading or exporting, the results of a Document with errors are incomplete
+        #parsed legacy state saved in a snapshot, see save_legacy_snapshot
+        self.snapshot_fields = ["doc_id", "doc_title", "release_no", "title", "legacydir", "input_pub_file_name", "sourcefile",
+                                "max_doc_resolution", "page_count", "PagesImgResolutions", "PagesImgName", "PagesResolutionFactor", "PagesImgVariant",
+                                "PagesXmlName", "pxmlOutname", "PagesImgHeight", "PagesImgWidth", "EntitiesIndex", "EntitiesPage",
+                                "article_types", "ContentPrimitives", "PrimitivesIndexInPage", "RegionBoxing", "LineBoxing",
+                                "LineIndexInRegion", "PrimitiveTypes", "PagesPrimitives", "EntityPrimitives", "legacy_articles",
+                                "HeaderPrimitives"]
 
     #remove garbage lines by identifying lines with very small width
     def is_garbage_line(self, linebox):
@@ -91,112 +128,212 @@ class Document:
         except:
             return
         
-    #read Arxxx.xml file
-    def get_legacy_entity_data(self, input_file_name):
-        try:
-            tree = etree.parse(input_file_name)
-            #this works only for content primitives, rest of them are in Pgxxx.xml
-            for content_child in tree.xpath('//Primitive'):
-                content_id = content_child.get("ID")
-                id_count = 1
-                count = 1
-                for line_child in content_child.xpath("L"):
-                    line_id = content_id + "_" + str(id_count)
-                    id_count = id_count + 1 #keeping full id count even if skipped, for backward compatibility
-                    line_seq = count
-                    legacy_box = line_child.get("BOX")
-                    if not self.is_garbage_line(legacy_box):
-                        line_box = self.calc_coordinates(self.modify_legacy_line_box(legacy_box, self.cut_low_line_part), self.factor1, self.factor2)
-                        self.LineIndexInRegion[line_id] = line_seq
-                        self.LineBoxing[line_id] = line_box
-                        count = count + 1
-        except Exception as e:
-            print("ERROR in get_legacy_entity_data " + input_file_name)
-            print (e)
-            print ("END ERROR \n\n")
-            pass
-    
-    def check_unzip(self, input_folder):
-        input_zip = input_folder + ".zip"
-        if not os.path.isdir(input_folder) and os.path.isfile(input_zip):
-            os.makedirs(input_folder)
-            os.chdir(os.path.dirname(input_zip))
-            fh = open(input_zip, 'rb')
-            z = zipfile.ZipFile(fh)
-            for name in z.namelist():
-                z.extract(name, input_folder)
-            fh.close()
+    #open a legacy file for reading, from the Document folder or from Document.zip
+    def open_legacy_file(self, file_name):
+        if self.legacy_source is not None:
+            return self.legacy_source.open(file_name)
+        return open(file_name, 'rb')
+
+    #return the TOC.xml model, parsing the file only if it was not loaded yet
+    def load_legacy_toc(self, tocfile):
+        if self.toc is None or os.path.abspath(self.toc.sourcefile) != os.path.abspath(tocfile):
+            self.toc = legacy_toc(tocfile)
+        return self.toc
 
     def get_toc_article_types(self, tocfile):
-        ettree = ET.parse(tocfile)
-        xroot = ettree.getroot()
-        for a in xroot.findall("Logic_np/TOC_Entries/TOC_Entry"):
-            aid = a.attrib["TOC_ENTRY_ID"]
-            atype = a.attrib["PRIM_ID_REF"][0:2]
-            self.article_types[aid] = atype
+        self.article_types.update(self.load_legacy_toc(tocfile).article_types)
     
-    def load_legacy_data(self, inputdir):
+    #workers > 1 reads the page files with a thread pool, output is identical to the sequential parse
+    #cachedir keeps a snapshot of the parsed issue, reused while the TOC.xml and Document files are unchanged
+    #no snapshot is saved when a page could not be read
+    @timed_stage("load_legacy_data", lambda self, result: self.page_count)
+    def load_legacy_data(self, inputdir, workers=1, cachedir=None):
         try:
-            #---- READING TOC FILE ---------------------#
-            self.legacydir = inputdir
-            self.input_pub_file_name = os.path.join(self.legacydir, self.legacy_metafile)
-            self.pick_max_resolution(self.input_pub_file_name)
-            tree = etree.parse(self.input_pub_file_name)
-            MetaElement = tree.xpath('//Xmd_toc')
-            self.release_no = MetaElement[0].get("RELEASE_NO")
-            self.title = MetaElement[0].get("RELEASE_NO")
-            release_parts = self.release_no.split("-")
-            self.doc_id = release_parts[2] + release_parts[3] + release_parts[4]
-            self.doc_title = release_parts[1] + "-"+ release_parts[2] +"-"+ release_parts[3] +"-"+ release_parts[4]
-            self.page_count = len(tree.xpath('//Page'))
-            self.check_unzip(os.path.join(inputdir, self.docdir))
-            for pgElement in tree.xpath('//Page'):
-                pgNum = pgElement.get("PAGE_NO")
-                pgXml = pgElement.get("ID") + ".xml"
-                self.PagesXmlName[pgNum] = os.path.join(inputdir, self.docdir, pgNum, pgXml)
-                
-            #---- READING IMG RESOLUTIONS ---------------------#         
-            count = 1
-            while (count <= self.page_count):
-                self.parse_legacy_page_img_resolution(str(count))
-                count +=1
-                
-            for pgElement in tree.xpath('//Page'):
-                pgNum = pgElement.get("PAGE_NO")
-                pgId = pgElement.get("ID")
-                self.pxmlOutname[pgNum] = pgId + "_" + self.PagesImgResolutions[str(pgNum)] + ".pxml"
-                self.PagesImgName[pgNum] = os.path.join(inputdir, self.docdir, pgNum, self.inputdir_images, pgId + "_" + self.PagesImgResolutions[str(pgNum)] + ".png")
-                if os.path.exists(self.PagesImgName[pgNum]):
-                    self.PagesResolutionFactor[pgNum] = 1
-                else:
-                    self.PagesResolutionFactor[pgNum] = float(self.max_doc_resolution) / float(self.PagesImgResolutions[str(pgNum)])
-                    self.PagesImgName[pgNum] = os.path.join(inputdir, self.docdir, pgNum, self.inputdir_images, pgId + "_" + str(self.max_doc_resolution) + ".png")
-                    self.pxmlOutname[pgNum] = pgId + "_" + str(self.max_doc_resolution) + ".pxml"
-            for entityElement in tree.xpath('//Entity'):
-                entityId = entityElement.get("ID")
-                pgIndex = entityElement.get("PAGE_NO")
-                tocIndex = entityElement.get("FIRST_TOC_ENTRY_ID")
-                self.EntitiesPage[entityId] = pgIndex
-                self.EntitiesIndex[entityId] = tocIndex
+            if cachedir is not None and self.load_legacy_snapshot(inputdir, cachedir, "data"):
+                return
+            self.read_legacy_meta(inputdir)
             #---- READING PAGE FILES --------------------#
-            count = 1
-            while (count <= self.page_count):
-                self.parse_legacy_page_data(str(count), self.PagesResolutionFactor[str(count)])
-                count +=1  
+            if workers > 1:
+                self.parse_legacy_pages_data([str(count) for count in range(1, self.page_count + 1)], workers)
+            else:
+                count = 1
+                while (count <= self.page_count):
+                    self.parse_legacy_page_data(str(count), self.PagesResolutionFactor[str(count)])
+                    count +=1
             self.load_legacy_articles(self.input_pub_file_name)
             self.get_toc_article_types(self.input_pub_file_name)
+            if cachedir is not None and not self.errors:
+                self.save_legacy_snapshot(inputdir, cachedir, "data")
+        except MemoryError:
+            raise
         except Exception as e:
+            self.errors.append(e)
             print("ERROR in load_legacy_data for inputdir " + inputdir)
             print (e)
             print ("END ERROR \n\n")
             exit
 
+    #fast load from TOC.xml and the Pgxxx.xml Meta headers only, no Arxxx.xml file is read
+    #gives titles, page, image and pxml names, entities, legacy articles and article types, but no region data
+    #headers=True also collects HeaderPrimitives from the Pgxxx.xml primitive types, for match_legacy_articles
+    #a snapshot of the full load_legacy_data is also used, it holds everything the meta load gives
+    @timed_stage("load_legacy_meta", lambda self, result: self.page_count)
+    def load_legacy_meta(self, inputdir, headers=False, cachedir=None):
+        level = "headers" if headers else "meta"
+        try:
+            if cachedir is not None:
+                if self.load_legacy_snapshot(inputdir, cachedir, "data") or self.load_legacy_snapshot(inputdir, cachedir, level):
+                    return
+            self.read_legacy_meta(inputdir)
+            if headers:
+                count = 1
+                while (count <= self.page_count):
+                    self.HeaderPrimitives.extend(self.scan_legacy_page_headers(str(count)))
+                    count +=1
+            self.load_legacy_articles(self.input_pub_file_name)
+            self.get_toc_article_types(self.input_pub_file_name)
+            if cachedir is not None and not self.errors:
+                self.save_legacy_snapshot(inputdir, cachedir, level)
+        except MemoryError:
+            raise
+        except Exception as e:
+            self.errors.append(e)
+            print("ERROR in load_legacy_meta for inputdir " + inputdir)
+            print (e)
+            print ("END ERROR \n\n")
+
+    #(relative path, size, mtime) of TOC.xml, of Document.zip and of the XML files of the Document folder
+    #the other files of the Document folder (the page images) are listed by name only, size and mtime None,
+    #unless images=True, the parsed state depends on which images there are but not on their content
+    def legacy_fingerprint(self, inputdir, images=False):
+        fingerprint = []
+        pending = [inputdir]
+        docdir = os.path.join(inputdir, self.docdir)
+        while pending:
+            folder = pending.pop()
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if folder == inputdir and entry.name not in (self.legacy_metafile, self.docdir, self.docdir + ".zip"):
+                        continue
+                    if entry.is_dir():
+                        pending.append(entry.path)
+                    elif images or folder == inputdir or entry.name.lower().endswith(".xml"):
+                        stat = entry.stat()
+                        fingerprint.append((os.path.relpath(entry.path, inputdir), stat.st_size, stat.st_mtime_ns))
+                    else:
+                        fingerprint.append((os.path.relpath(entry.path, inputdir), None, None))
+        fingerprint.sort()
+        return fingerprint
+
+    #settings that change the parsed state, a snapshot made with other settings is not used
+    def legacy_snapshot_settings(self):
+        return (self.legacy_metafile, self.docdir, self.inputdir_images, self.cut_low_line_part, self.legacy_garbage_width,
+                self.headline_primitive_type, self.frame_primitive_type, self.graphic_primitive_type)
+
+    def legacy_snapshot_file(self, inputdir, cachedir, level):
+        inputdir = os.path.abspath(inputdir)
+        key = hashlib.sha1(inputdir.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(cachedir, os.path.basename(inputdir) + "_" + key + "_" + level + ".pickle")
+
+    #write the parsed legacy state of inputdir, level is data, meta or headers
+    def save_legacy_snapshot(self, inputdir, cachedir, level):
+        try:
+            self.prep_dir(cachedir)
+            snapshot_file = self.legacy_snapshot_file(inputdir, cachedir, level)
+            snapshot = {"version": LEGACY_SNAPSHOT_VERSION,
+                        "inputdir": os.path.abspath(inputdir),
+                        "settings": self.legacy_snapshot_settings(),
+                        "fingerprint": self.legacy_fingerprint(inputdir),
+                        "state": dict((field, getattr(self, field)) for field in self.snapshot_fields)}
+            temp_file = snapshot_file + "." + str(os.getpid()) + ".tmp"
+            with open(temp_file, 'wb') as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, snapshot_file)
+        except Exception as e:
+            print("ERROR in save_legacy_snapshot for inputdir " + inputdir)
+            print (e)
+            print ("END ERROR \n\n")
+
+    #restore the parsed legacy state of inputdir, returns False when there is no snapshot or it is stale
+    def load_legacy_snapshot(self, inputdir, cachedir, level):
+        snapshot_file = self.legacy_snapshot_file(inputdir, cachedir, level)
+        if not os.path.isfile(snapshot_file):
+            return False
+        try:
+            with open(snapshot_file, 'rb') as f:
+                snapshot = pickle.load(f)
+            if (snapshot["version"] != LEGACY_SNAPSHOT_VERSION
+                    or snapshot["inputdir"] != os.path.abspath(inputdir)
+                    or snapshot["settings"] != self.legacy_snapshot_settings()
+                    or snapshot["fingerprint"] != self.legacy_fingerprint(inputdir)):
+                return False
+            for field, value in snapshot["state"].items():
+                setattr(self, field, value)
+            self.legacy_source = legacy_source(os.path.join(self.legacydir, self.docdir))
+            return True
+        except Exception as e:
+            print("Warning unreadable legacy snapshot " + snapshot_file + ", parsing the issue again")
+            print (e)
+            return False
+
+    #TOC.xml and Pgxxx.xml Meta data shared by load_legacy_data and load_legacy_meta
+    #the paths kept are absolute, as the snapshots that hold them are checked against the absolute inputdir
+    def read_legacy_meta(self, inputdir):
+        inputdir = os.path.abspath(inputdir)
+        #---- READING TOC FILE ---------------------#
+        self.legacydir = inputdir
+        self.input_pub_file_name = os.path.join(self.legacydir, self.legacy_metafile)
+        self.pick_max_resolution(self.input_pub_file_name)
+        toc = self.load_legacy_toc(self.input_pub_file_name)
+        self.release_no = toc.release_no
+        self.title = toc.release_no
+        release_parts = self.release_no.split("-")
+        self.doc_id = release_parts[2] + release_parts[3] + release_parts[4]
+        self.doc_title = release_parts[1] + "-"+ release_parts[2] +"-"+ release_parts[3] +"-"+ release_parts[4]
+        self.page_count = len(toc.pages)
+        self.legacy_source = legacy_source(os.path.join(inputdir, self.docdir))
+        for pgNum, pgId in toc.pages:
+            pgXml = pgId + ".xml"
+            self.PagesXmlName[pgNum] = os.path.join(inputdir, self.docdir, pgNum, pgXml)
+            
+        #---- READING IMG RESOLUTIONS ---------------------#         
+        count = 1
+        while (count <= self.page_count):
+            self.parse_legacy_page_img_resolution(str(count))
+            count +=1
+            
+        for pgNum, pgId in toc.pages:
+            resolution, self.PagesResolutionFactor[pgNum] = self.pick_legacy_page_image(pgNum, pgId)
+            self.PagesImgVariant[pgNum] = resolution
+            self.pxmlOutname[pgNum] = pgId + "_" + resolution + ".pxml"
+            self.PagesImgName[pgNum] = os.path.join(inputdir, self.docdir, pgNum, self.inputdir_images, pgId + "_" + resolution + ".png")
+        for entityId, pgIndex, tocIndex in toc.entities:
+            self.EntitiesPage[entityId] = pgIndex
+            self.EntitiesIndex[entityId] = tocIndex
+
+    #(resolution, resolution factor) of the page image, chosen from one listing of the page Img folder:
+    #the page resolution, else the max resolution of the issue, else the largest resolution listed for the page
+    #the max resolution is also kept when no image of the page is listed
+    def pick_legacy_page_image(self, pgNum, pgId):
+        page_resolution = self.PagesImgResolutions[pgNum]
+        prefix = pgId + "_"
+        listed = {}
+        for name in self.legacy_source.listdir(os.path.join(self.legacydir, self.docdir, pgNum, self.inputdir_images)):
+            variant = name[len(prefix):-len(".png")]
+            if name.startswith(prefix) and name.endswith(".png") and variant.isdigit():
+                listed[variant] = int(variant)
+        if page_resolution in listed:
+            return page_resolution, 1
+        resolution = str(self.max_doc_resolution)
+        if listed and resolution not in listed:
+            resolution = max(listed, key=listed.get)
+        return resolution, float(resolution) / float(page_resolution)
+
     def pick_max_resolution(self, legacy_meta_file):
         try:
-            tree = etree.parse(legacy_meta_file)
+            toc = self.load_legacy_toc(legacy_meta_file)
             resolution = 0
-            for resElement in tree.xpath('//Resolution'):
-                resText = resElement.text
+            for resText in toc.resolutions:
                 if int(resText) > resolution:
                     resolution = int(resText)
             self.max_doc_resolution = resolution
@@ -222,68 +359,173 @@ class Document:
     #parse Pg00x.xml file
     def parse_legacy_page_img_resolution(self, PgCount):
         try:
-            tree = etree.parse(self.PagesXmlName[PgCount])
-            MetaElement = tree.xpath('//XMD-PAGE/Meta')
-            self.PagesImgResolutions[PgCount] = MetaElement[0].get("IMAGES_RESOLUTION")
+            self.PagesImgResolutions[PgCount] = self.probe_legacy_page_meta(self.PagesXmlName[PgCount]).get("IMAGES_RESOLUTION")
         except Exception as e:
+            self.errors.append(e)
             print("ERROR in parse_legacy_page_img_resolution for page " + PgCount)
             print (e)
             print ("END ERROR \n\n")
             pass
  
+    #read XMD-PAGE/Meta attributes of Pg00x.xml file, stops reading the file once Meta is found
+    def probe_legacy_page_meta(self, pgfile):
+        parser = etree.XMLPullParser(events=("start",), tag="Meta")
+        with self.open_legacy_file(pgfile) as f:
+            chunk = f.read(self.probe_chunk_size)
+            while chunk:
+                parser.feed(chunk)
+                for event, elem in parser.read_events():
+                    parent = elem.getparent()
+                    if parent is not None and parent.tag == "XMD-PAGE":
+                        return dict(elem.attrib)
+                chunk = f.read(self.probe_chunk_size)
+        raise ValueError("XMD-PAGE/Meta not found in " + pgfile)
+
+    #ids of the headline primitives of Pg00x.xml file, read without the Arxxx.xml files
+    def scan_legacy_page_headers(self, PgCount):
+        headers = []
+        with self.open_legacy_file(self.PagesXmlName[PgCount]) as f:
+            for event, elem in etree.iterparse(f, events=("end",), tag="Primitive"):
+                if elem.get("ELEMENT_TYPE") == self.headline_primitive_type:
+                    headers.append(elem.get("ID"))
+                elem.clear()
+        return headers
+
     #parse Pg00x.xml file
     def parse_legacy_page_data(self, PgCount, resolution_factor):
+        self.apply_legacy_page_data(self.read_legacy_page_data(PgCount, resolution_factor))
+
+    #read Pg00x.xml file and its Arxxx.xml boxes into a legacy_page, without changing the Document
+    def read_legacy_page_data(self, PgCount, resolution_factor):
+        page = legacy_page(PgCount)
         try:
-            tree = etree.parse(self.PagesXmlName[PgCount])
+            with self.open_legacy_file(self.PagesXmlName[PgCount]) as f:
+                tree = etree.parse(f)
             dir_path = (os.path.dirname(self.PagesXmlName[PgCount])) # dir of page file
-            
+
             MetaElement = tree.xpath('//XMD-PAGE/Meta')
+            page.meta = (MetaElement[0].get("PAGE_HEIGHT"), MetaElement[0].get("PAGE_WIDTH"))
+
+            box_index = {} #key: Arxxx.xml path, value: ID->BOX index, each file parsed once per page
+            pending = [] #(id, SEQ_NO, ELEMENT_TYPE) of primitives whose boxes are converted in one batch
+            legacy_boxes = []
+            legacy_lines = [] #(line id, index in region, BOX) of the lines of the Arxxx.xml files read for the page
+            try:
+                for node in tree.xpath('//Primitive'): #all primitives needed
+                    content_id = node.get("ID")
+                    page.content_primitives.append(content_id)
+                    legacy_box = self.get_legacy_box(content_id, dir_path, box_index, legacy_lines)
+                    if legacy_box is None or len(legacy_box.split()) != 4:
+                        raise ValueError("missing or malformed BOX for primitive " + content_id)
+                    pending.append((content_id, node.get("SEQ_NO"), node.get("ELEMENT_TYPE")))
+                    legacy_boxes.append(legacy_box)
+            except Exception as e:
+                page.error = e #primitives read before the error are kept, as in a sequential read
+            coordinates = self.convert_legacy_boxes(legacy_boxes, resolution_factor)
+            for (content_id, content_seq, prim_type), points in zip(pending, coordinates):
+                page.primitives.append((content_id, content_seq, prim_type, points))
+            try:
+                line_coordinates = self.convert_legacy_boxes([box for line_id, line_seq, box in legacy_lines], resolution_factor, self.cut_low_line_part)
+                for (line_id, line_seq, box), points in zip(legacy_lines, line_coordinates):
+                    page.lines.append((line_id, line_seq, points))
+            except Exception as e:
+                page.error = page.error or e
+        except Exception as e:
+            page.error = e
+        return page
 
-            self.PagesImgHeight[PgCount] = MetaElement[0].get("PAGE_HEIGHT")
-            self.PagesImgWidth[PgCount] = MetaElement[0].get("PAGE_WIDTH")
-
-            self.HeaderPrimitives
-            for node in tree.xpath('//Primitive'): #all primitives needed
-                content_id = node.get("ID")
-                self.ContentPrimitives.append(content_id)
-                
-                content_seq = node.get("SEQ_NO") 
-                content_id = node.get("ID")
-                legacy_box = (self.get_correct_box_coordinates(content_id, dir_path, resolution_factor))
-                left, bottom, right, top = legacy_box.split()
-                coordinates = right + "," + top + " " + left + "," + top + " " + left + "," + bottom + " " + right + "," + bottom
-                prim_type = node.get("ELEMENT_TYPE")
+    #merge a legacy_page into the Document registries, pages must be merged in page order
+    def apply_legacy_page_data(self, page):
+        try:
+            if page.meta is not None:
+                self.PagesImgHeight[page.number], self.PagesImgWidth[page.number] = page.meta
+            self.ContentPrimitives.update(page.content_primitives)
+            page_primitives = self.PagesPrimitives.setdefault(page.number, [])
+            page_headers = []
+            for content_id, content_seq, prim_type, coordinates in page.primitives:
                 if (prim_type != self.frame_primitive_type):
+                    if content_id not in self.PrimitivesIndexInPage:
+                        page_primitives.append(content_id)
+                        self.EntityPrimitives.setdefault(content_id[:-2], []).append(content_id)
                     self.PrimitivesIndexInPage[content_id] = content_seq
                     self.PrimitiveTypes[content_id] = prim_type
                     self.RegionBoxing[content_id] = coordinates
                     if (prim_type == self.headline_primitive_type):
                         self.HeaderPrimitives.append(content_id)
-            for header in self.HeaderPrimitives:
+                        page_headers.append(content_id)
+            for line_id, line_seq, coordinates in page.lines:
+                self.LineIndexInRegion[line_id] = line_seq
+                self.LineBoxing[line_id] = coordinates
+            if page.error is not None:
+                raise page.error
+            for header in page_headers: #headers of earlier pages were already moved to the top
                 if (self.PrimitivesIndexInPage[header] != "0"):
                     primitive_entity = header[:-2] #remove 2 last chars
                     self.PrimitivesIndexInPage[header] = "0"
-                    for primitive in self.PrimitivesIndexInPage.keys():
-                        if (primitive.startswith(primitive_entity) and (primitive != header)):
+                    for primitive in self.EntityPrimitives[primitive_entity]:
+                        if (primitive != header):
                             original_index = int(self.PrimitivesIndexInPage[primitive])
                             self.PrimitivesIndexInPage[primitive] = str(original_index + 1) #assuming headline had the last index
+        except MemoryError:
+            raise
         except Exception as e:
-            print("ERROR in parse_legacy_page_data for page " + PgCount)
+            self.errors.append(e)
+            print("ERROR in parse_legacy_page_data for page " + page.number)
             print (e)
             print ("END ERROR \n\n")
             pass
-    
+
+    #read pages concurrently, then merge them in page order so the result matches the sequential parse
+    def parse_legacy_pages_data(self, PgCounts, workers):
+        factors = [self.PagesResolutionFactor[PgCount] for PgCount in PgCounts]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = list(executor.map(self.read_legacy_page_data, PgCounts, factors))
+        for page in pages:
+            self.apply_legacy_page_data(page)
+
     #return the correct coordinate from ar00x file for every ar00?0? id
-    def get_correct_box_coordinates(self, ar_id, path, resolution_factor): 
+    def get_correct_box_coordinates(self, ar_id, path, resolution_factor, box_index=None):
+        box = self.get_legacy_box(ar_id, path, box_index)
+        if box is not None:
+            return self.fix_factor(box, resolution_factor)
+
+    #return the legacy BOX of an ar00?0? id, as written in its ar00x file
+    #lines, when given, receives the lines of every ar00x file parsed here, see get_legacy_entity_lines
+    def get_legacy_box(self, ar_id, path, box_index=None, lines=None):
         file_name = ar_id[:-2]
-        file_path = os.path.join(path, file_name)
-        tree = etree.parse(file_path + ".xml")
+        file_path = os.path.join(path, file_name) + ".xml"
+        if box_index is None:
+            box_index = {}
+        if file_path not in box_index:
+            box_index[file_path] = self.get_legacy_box_index(file_path, lines)
+        return box_index[file_path].get(ar_id)
+
+    #parse ar00x file once, key: primitive or image id, value: legacy BOX
+    def get_legacy_box_index(self, file_path, lines=None):
+        with self.open_legacy_file(file_path) as f:
+            tree = etree.parse(f)
+        boxes = {}
         for node in tree.xpath('//Primitive'):
-            if (node.get("ID")) == ar_id:
-                return self.fix_factor(node.get("BOX"), resolution_factor)
+            boxes.setdefault(node.get("ID"), node.get("BOX"))
         for node in tree.xpath('//Img'):
-            if (node.get("ID")) == ar_id:
-                return self.fix_factor(node.get("BOX"), resolution_factor)
+            boxes.setdefault(node.get("ID"), node.get("BOX"))
+        if lines is not None:
+            lines.extend(self.get_legacy_entity_lines(tree))
+        return boxes
+
+    #(line id, index in region, legacy BOX) of the L lines of the content primitives of a parsed ar00x file
+    #garbage lines are skipped, they keep their number in the line id but not in the index
+    def get_legacy_entity_lines(self, tree):
+        lines = []
+        for content_child in tree.xpath('//Primitive'):
+            content_id = content_child.get("ID")
+            count = 1
+            for id_count, line_child in enumerate(content_child.xpath("L"), 1):
+                legacy_box = line_child.get("BOX")
+                if not self.is_garbage_line(legacy_box):
+                    lines.append((content_id + "_" + str(id_count), count, legacy_box))
+                    count = count + 1
+        return lines
 
     #In case image resolution is different that coordinates resolution
     def fix_factor(self, box, factor):
@@ -296,6 +538,37 @@ class Document:
             print("fix_factor failed")
             return box
     
+    #convert legacy "left top right bottom" BOX strings to 4 point PAGE coordinates, as one array per batch
+    #cut_low_part removes that part of the box height from its bottom, used for lines
+    def convert_legacy_boxes(self, boxes, resolution_factor, cut_low_part=0):
+        if len(boxes) == 0:
+            return []
+        try:
+            coordinates = np.array([box.split(" ") for box in boxes], dtype=np.int64)
+        except ValueError:
+            return [self.legacy_box_points(box, resolution_factor, cut_low_part) for box in boxes]
+        if cut_low_part:
+            coordinates[:, 3] -= ((coordinates[:, 3] - coordinates[:, 1]) * cut_low_part).astype(np.int64)
+        coordinates = (coordinates * resolution_factor).astype(np.int64)
+        corners = coordinates[:, [2, 3, 0, 3, 0, 1, 2, 1]] #right,top left,top left,bottom right,bottom
+        return ["%d,%d %d,%d %d,%d %d,%d" % tuple(row) for row in corners.tolist()]
+
+    #single box version of convert_legacy_boxes, for boxes that are not plain integers
+    def legacy_box_points(self, box, resolution_factor, cut_low_part=0):
+        if cut_low_part:
+            box = self.modify_legacy_line_box(box, cut_low_part)
+        left, bottom, right, top = self.fix_factor(box, resolution_factor).split()
+        return right + "," + top + " " + left + "," + top + " " + left + "," + bottom + " " + right + "," + bottom
+
+    #remove the lower part of a line box
+    def modify_legacy_line_box(self, box, cut_low_part):
+        try:
+            left, top, right, bottom = [int(c) for c in box.split()]
+            bottom = bottom - int((bottom - top) * cut_low_part)
+            return " ".join([str(left), str(top), str(right), str(bottom)])
+        except:
+            return box
+
     def pxml_names_by_pgnum(self):
         return self.pxmlOutname
 
@@ -305,97 +578,186 @@ class Document:
                 imgOutname[key] = os.path.basename(value)
         return imgOutname
 
-    #write TKBS xml for a page
+    #reading order of every page, key: page num, value: list of (primitive id-name, region type)
+    def plan_transkribus_pages(self):
+        entities_by_page = {}
+        for entity in self.EntitiesIndex:
+            entities_by_page.setdefault(self.EntitiesPage[entity], []).append(entity)
+        self.PagesPlan = {}
+        for pageNum, entities in entities_by_page.items():
+            plan = []
+            for entity in entities:
+                ePrimitives = {}
+                for pkey in self.EntityPrimitives.get(entity, []):
+                    if pkey in self.ContentPrimitives:
+                        ePrimitives[self.PrimitivesIndexInPage[pkey]] = pkey
+                primitive_count = 0
+                while primitive_count <= (len(ePrimitives) + 1):
+                    if str(primitive_count) in ePrimitives:
+                        rPrimitive = ePrimitives[str(primitive_count)]
+                        RegionType = 'TextRegion'
+                        if (self.PrimitiveTypes[rPrimitive] == self.graphic_primitive_type):
+                            RegionType = 'GraphicRegion'
+                        plan.append((rPrimitive, RegionType))
+                    primitive_count = primitive_count + 1
+            self.PagesPlan[pageNum] = plan
+        return self.PagesPlan
+
+    #write TKBS xml for a page, streaming it from the reading order plan
     def write_transkribus_page_xml(self, pageCount):
         try:
+            if self.PagesPlan is None:
+                self.plan_transkribus_pages()
+            plan = self.PagesPlan.get(str(pageCount), [])
             pgTarget = os.path.join(self.tkbs_exportdir, self.pxmlOutname[pageCount])
             attr_qname = etree.QName(self.tkbs_xsi, "schemaLocation")
             nsmap = {None: self.tkbs_xml_schema, \
                      "xsi": self.tkbs_xsi}
-            root = etree.Element("PcGts", \
-                     {attr_qname: self.tkbs_xml_schema + " " + self.tkbs_xsd}, \
-                     nsmap=nsmap)
-            doc = etree.ElementTree(root)
-            Metadata = etree.SubElement(root, 'Metadata')
-            Page = etree.SubElement(root, 'Page')
-            Metadata.attrib['docId'] = self.doc_id
-            Metadata.attrib['pageNr'] = str(pageCount)
-            Metadata.attrib['pageId'] = self.doc_id + str(pageCount)
-            Metadata.attrib['tsid'] = "2" + self.doc_id + str(pageCount)
-            Page.attrib['imageHeight'] = self.PagesImgHeight[pageCount]
-            Page.attrib['imageWidth'] = self.PagesImgWidth[pageCount]
-            Page.attrib['imageFilename'] = os.path.basename(self.PagesImgName[pageCount])
-            ReadingOrder = etree.SubElement(Page, 'ReadingOrder')
-            OrderedGroup = etree.SubElement(ReadingOrder, 'OrderedGroup')
-            OrderedGroup.attrib['caption'] = "Regions reading order"
-            OrderedGroup.attrib['id'] = "ro_" + self.doc_id + str(pageCount)
-            primitive_count = 0
-            region_count = 0
-            ePrimitives = {}
-            for entity, tocIndex in self.EntitiesIndex.items():
-                if self.EntitiesPage[entity] == str(pageCount):
-                    ePrimitives = {}
-                    for pkey, pvalue in self.PrimitivesIndexInPage.items():
-                        if pkey.startswith(entity) and pkey in self.ContentPrimitives:
-                            ePrimitives[pvalue] = pkey
-                    ePrimitive_total = len(ePrimitives)
-                    primitive_count = 0
-                    while primitive_count <= (ePrimitive_total + 1):
-                        if str(primitive_count) in ePrimitives:
-                            rPrimitive = ePrimitives[str(primitive_count)]
-                            pRaw = '<RegionRefIndexed regionRef="' + rPrimitive + '" index="' + str(region_count) + '"/>'
-                            pNode = etree.fromstring(pRaw)
-                            OrderedGroup.append(pNode)
-                            RegionType = 'TextRegion'
-                            if (self.PrimitiveTypes[rPrimitive] == self.graphic_primitive_type):
-                                RegionType = 'GraphicRegion'
-                            tRaw = '<' + RegionType + ' id="' + rPrimitive + \
-                            '" custom="readingOrder {index:' + str(region_count) + ';}">' + \
-                            '<Coords points="' + self.RegionBoxing[rPrimitive] + '"/>' + \
-                            '</' + RegionType + '>'
-                            tNode = etree.fromstring(tRaw)
-                            if (self.PrimitiveTypes[rPrimitive] != self.graphic_primitive_type):
-                                lastNode = etree.fromstring('<TextEquiv><Unicode/></TextEquiv>')
-                                tNode.append(lastNode)
-                            region_count = region_count + 1
-                            Page.append(tNode)
-                        primitive_count = primitive_count + 1
-            doc.write(pgTarget)
+            Metadata = etree.Element('Metadata', {'docId': self.doc_id,
+                                                  'pageNr': str(pageCount),
+                                                  'pageId': self.doc_id + str(pageCount),
+                                                  'tsid': "2" + self.doc_id + str(pageCount)})
+            PageAttrib = {'imageHeight': self.PagesImgHeight[pageCount],
+                          'imageWidth': self.PagesImgWidth[pageCount],
+                          'imageFilename': os.path.basename(self.PagesImgName[pageCount])}
+            GroupAttrib = {'caption': "Regions reading order",
+                           'id': "ro_" + self.doc_id + str(pageCount)}
+            with etree.xmlfile(pgTarget) as xf:
+                with xf.element("PcGts", {attr_qname: self.tkbs_xml_schema + " " + self.tkbs_xsd}, nsmap=nsmap):
+                    xf.write(Metadata)
+                    with xf.element('Page', PageAttrib):
+                        with xf.element('ReadingOrder'):
+                            if len(plan) == 0:
+                                xf.write(etree.Element('OrderedGroup', GroupAttrib))
+                            else:
+                                with xf.element('OrderedGroup', GroupAttrib):
+                                    for region_count, (rPrimitive, RegionType) in enumerate(plan):
+                                        xf.write(etree.Element('RegionRefIndexed', {'regionRef': rPrimitive, 'index': str(region_count)}))
+                        for region_count, (rPrimitive, RegionType) in enumerate(plan):
+                            with xf.element(RegionType, {'id': rPrimitive, 'custom': "readingOrder {index:" + str(region_count) + ";}"}):
+                                xf.write(etree.Element('Coords', {'points': self.RegionBoxing[rPrimitive]}))
+                                if (RegionType != 'GraphicRegion'):
+                                    with xf.element('TextEquiv'):
+                                        xf.write(etree.Element('Unicode'))
+        except MemoryError:
+            raise
         except Exception as e:
+            self.errors.append(e)
             print("ERROR in write_transkribus_page_xml for page number " + pageCount)
             print (e)
             print ("END ERROR \n\n")
             pass
 
-    #copy images
+    #stage the page images with image_staging, falling back to the next strategy when one is not possible
+    #returns how many images this call staged or copied
+    @timed_stage("copy_transkribus_images", lambda self, result: result)
     def copy_transkribus_images(self, outdir):
+        copied = 0
         try:
+            pending = [] #(page num, image, target file)
             for key, value in self.PagesImgName.items():
                 target_file = os.path.join(outdir, os.path.basename(value))
-                if not os.path.isfile(target_file):
+                if self.legacy_source is not None:
+                    if self.legacy_source.changed(value, target_file):
+                        pending.append((key, value, target_file))
+                elif not os.path.isfile(target_file):
                     copyfile(value, target_file)
+                    copied += 1
+            strategies = self.image_staging_fallback[self.image_staging]
+            with ThreadPoolExecutor(max_workers=self.image_copy_workers) as executor:
+                staged = executor.map(lambda item: self.stage_transkribus_image(item[1], item[2], strategies), pending)
+                for (key, value, target_file), strategy in zip(pending, staged):
+                    if strategy is not None:
+                        self.PagesImgStaging[key] = strategy
+                        copied += 1
+        except MemoryError:
+            raise
         except Exception as e:
+            self.errors.append(e)
             print("ERROR in copy_transkribus_images " + outdir)
             print (e)
             print ("END ERROR \n\n")
-            pass
+        return copied
+
+    #stage one page image, returns the strategy used or None if the image could not be staged
+    #an image that fails does not stop the staging of the other pages
+    def stage_transkribus_image(self, image, target_file, strategies):
+        try:
+            return self.legacy_source.stage(image, target_file, strategies)
+        except MemoryError:
+            raise
+        except Exception as e:
+            self.errors.append(e)
+            print("ERROR in stage_transkribus_image " + image)
+            print (e)
+            print ("END ERROR \n\n")
+            return None
 
-    def export_tkbs_format(self, exportdir):
+    #release_pages=True drops the region data of every page once its PAGE XML is written, for a Document that is not exported again
+    @timed_stage("export_tkbs_format", lambda self, result: self.page_count)
+    def export_tkbs_format(self, exportdir, release_pages=False):
         try:
             self.tkbs_exportdir = exportdir
             self.prep_dir(self.tkbs_exportdir)
             self.copy_transkribus_images(self.tkbs_exportdir)# + "\\" + self.release_no)
+            self.plan_transkribus_pages()
+            if release_pages:
+                references = self.release_plan_sources()
             count = 1
             while (count <= self.page_count):
                 #print("write_transkribus_page_xml " + str(count) + " of " + str(self.page_count))
                 self.write_transkribus_page_xml(str(count))
+                if release_pages:
+                    self.release_page_state(str(count), references)
                 count = count + 1
+        except MemoryError:
+            raise
         except Exception as e:
+            self.errors.append(e)
             print("ERROR in export_tkbs_format " + self.tkbs_exportdir)
             print (e)
             print ("END ERROR \n\n")
             pass
 
+    #the reading order plan holds all that is left to write, drop the registries it was made from
+    #returns how many page plans use each primitive
+    def release_plan_sources(self):
+        self.ContentPrimitives = set()
+        self.PrimitivesIndexInPage = {}
+        self.PagesPrimitives = {}
+        self.EntityPrimitives = {}
+        self.LineBoxing = {}
+        self.LineIndexInRegion = {}
+        references = {}
+        for plan in self.PagesPlan.values():
+            for rPrimitive, RegionType in plan:
+                references[rPrimitive] = references.get(rPrimitive, 0) + 1
+        return references
+
+    #drop the plan and region data of a written page, primitives still in the plan of another page are kept
+    def release_page_state(self, pageCount, references):
+        for rPrimitive, RegionType in self.PagesPlan.pop(pageCount, []):
+            references[rPrimitive] -= 1
+            if references[rPrimitive] == 0:
+                self.RegionBoxing.pop(rPrimitive, None)
+                self.PrimitiveTypes.pop(rPrimitive, None)
+
+    #release the legacy source and all parsed data, settings are kept and the Document can be loaded again
+    def close(self):
+        if self.legacy_source is not None:
+            self.legacy_source.close()
+        self.legacy_source = None
+        for field in self.snapshot_fields:
+            value = getattr(self, field)
+            setattr(self, field, type(value)() if isinstance(value, (dict, list, set)) else None)
+        self.page_count = 0
+        self.toc = None
+        self.PagesPlan = None
+        self.PagesImgStaging = {}
+        self.pages = {}
+        self.articles = {}
+
+    @timed_stage("load_tkbs_data", lambda self, result: len(self.pages))
     def load_tkbs_data(self, docdir):
         self.tkbs_load_dir = docdir
         metafile = os.path.join(self.tkbs_load_dir, self.tkbs_meta_filename)
@@ -421,6 +783,7 @@ class Document:
             ids[pnumber] = pid
         return ids
 
+    @timed_stage("export_plaintext", lambda self, result: len(self.articles))
     def export_plaintext(self, outdir):
         try:
             self.prep_dir(outdir)
@@ -428,12 +791,15 @@ class Document:
                 for a in self.articles.values():
                     for r in a.article_regions.values():
                         o.write(r.text)
+        except MemoryError:
+            raise
         except Exception as e:
             print("ERROR in export_plaintext " + outdir)
             print (e)
             print ("END ERROR \n\n")
             pass
 
+    @timed_stage("match_legacy_articles", lambda self, result: len(self.articles))
     def match_legacy_articles(self):
         self.articles = {}
         for akey in self.legacy_articles:
@@ -462,26 +828,22 @@ class Document:
     def load_legacy_articles(self, metafile):
         if os.path.isfile(metafile):
             self.sourcefile = metafile
-            tree = ET.parse(metafile)
-            xroot = tree.getroot()
+            toc = self.load_legacy_toc(metafile)
             self.legacy_articles = {}
-            for a in xroot.findall("Logic_np/TOC_Entries/TOC_Entry"):
-                aid = a.attrib["TOC_ENTRY_ID"]
-                atitle = a.attrib["TITLE"]
-                aprimitive = a.attrib["PRIM_ID_REF"]
-                aentity = a.attrib["ENTITY_ID_REF"]
+            for a in toc.toc_entries:
+                aid = a["TOC_ENTRY_ID"]
+                atitle = a["TITLE"]
+                aprimitive = a["PRIM_ID_REF"]
+                aentity = a["ENTITY_ID_REF"]
                 self.legacy_articles[aid] = legacy_article(aid, atitle, aprimitive, aentity)
-            for s in xroot.findall("Body_np/Section"):
-                for p in s.findall("Page"):
-                    for e in p.findall("Entity"):
-                        eid = e.attrib["ID"]
-                        eentry = e.attrib["FIRST_TOC_ENTRY_ID"]
-                        if eentry in self.legacy_articles.keys():
-                            self.legacy_articles[eentry].entities[eid] = legacy_entity(eid)
-                        else:
-                            print("Warning TOC ENTRY ID " + eentry + " MISSING in " + metafile)
+            for eid, eentry in toc.body_entities:
+                if eentry in self.legacy_articles.keys():
+                    self.legacy_articles[eentry].entities[eid] = legacy_entity(eid)
+                else:
+                    print("Warning TOC ENTRY ID " + eentry + " MISSING in " + metafile)
 
 
+    @timed_stage("export_csv_by_line", lambda self, result: len(self.pages))
     def export_csv_by_line(self, outdir):
         try:
             self.prep_dir(outdir)
@@ -501,12 +863,15 @@ class Document:
                             lid = lids[len(lids)-1]
                             writer.writerow({'article_id': str(aid), 'headline': header, 'region_id': str(rid), 'page_id': str(pid), 'line_id': str(lid), 'text': self.articles[a].article_regions[r].lines[l].text})
                             #o.write("%s,%s,%s,%s,%s\n" %(aid, rid, pid, lid, f'{self.articles[a].article_regions[r].lines[l].text}'))
+        except MemoryError:
+            raise
         except Exception as e:
             print("ERROR in export_csv " + outdir)
             print (e)
             print ("END ERROR \n\n")
             pass
 
+    @timed_stage("export_csv_regions", lambda self, result: len(self.pages))
     def export_csv_regions(self, outdir):
         try:
             self.prep_dir(outdir)
@@ -526,6 +891,8 @@ class Document:
                             region_text = " ".join([region_text, self.articles[a].article_regions[r].lines[l].text])
                         writer.writerow({'article_id': str(aid), 'headline': header, 'region_id': str(rid), 'page_id': str(pid), 'text': region_text})
 
+        except MemoryError:
+            raise
         except Exception as e:
             print("ERROR in export_csv " + outdir)
             print (e)
@@ -533,6 +900,7 @@ class Document:
             pass
 
 
+    @timed_stage("export_csv_articles", lambda self, result: len(self.articles))
     def export_csv_articles(self, outdir):
         try:
             self.prep_dir(outdir)
@@ -549,12 +917,15 @@ class Document:
                         for l in self.articles[a].article_regions[r].lines.keys():
                             articletext = " ".join([articletext, self.articles[a].article_regions[r].lines[l].text])
                     writer.writerow({'article_id': str(aid), 'headline': header, 'text': articletext})
+        except MemoryError:
+            raise
         except Exception as e:
             print("ERROR in export_csv " + outdir)
             print (e)
             print ("END ERROR \n\n")
             pass
 
+    @timed_stage("export_plaintext_articles", lambda self, result: len(self.articles))
     def export_plaintext_articles(self, outdir):
         try:
             self.prep_dir(outdir)
@@ -562,12 +933,15 @@ class Document:
                 with open(os.path.join(outdir, self.title + "_" + self.article_types[a] + "_" + str(a) + "_plaintext.txt"), mode = 'w', encoding = self.xmlcode) as o:
                     for r in self.articles[a].article_regions.values():
                         o.write(r.text)
+        except MemoryError:
+            raise
         except Exception as e:
             print("ERROR in export_plaintext " + outdir)
             print (e)
             print ("END ERROR \n\n")
             pass
 
+    @timed_stage("export_tei", lambda self, result: len(self.articles))
     def export_tei(self, outdirectory):
         try:
             TEI = ET.Element("TEI", attrib = {"xmlns": "http://www.tei-c.org/ns/1.0", "style": "direction:rtl; unicode-bidi:embed"})
@@ -638,6 +1012,8 @@ class Document:
                     divs[a_id].append(p[r_id])
             tree = ET.ElementTree(TEI)
             tree.write(os.path.join(outdirectory, self.title + "_tei.xml"), encoding="UTF-8", xml_declaration=True)
+        except MemoryError:
+            raise
         except Exception as e:
             print("ERROR in export_tei " + outdirectory)
             print (e)
@@ -692,6 +1068,7 @@ class tkbs_page:
             
             
 class tkbs_line:
+    __slots__ = ("id", "index", "coordinates", "text")
 
     def __init__(self, id, order, coords, text):
         self.id = id
@@ -700,6 +1077,7 @@ class tkbs_line:
         self.text = text
 
 class tkbs_region:
+    __slots__ = ("id", "pagenumber", "readingorder", "coordinates", "text", "lines")
 
     def __init__(self, regid, regindex, page):
         self.id = regid
@@ -710,6 +1088,7 @@ class tkbs_region:
         self.lines = {}
 
 class tkbs_article:
+    __slots__ = ("id", "header_region", "header", "primitive_primary", "entity_primary", "article_regions")
 
     def __init__(self, toc_entry_id, header_region, header, primitive_primary, entity_primary):
         self.id = "toc_" + toc_entry_id
@@ -720,6 +1099,7 @@ class tkbs_article:
         self.article_regions = {}
 
 class legacy_article:
+    __slots__ = ("id", "header_text", "primitive_primary", "entity_primary", "entities")
 
     def __init__(self, toc_entry_id, header_text, primitive_primary, entity_primary):
         self.id = toc_entry_id
@@ -729,11 +1109,289 @@ class legacy_article:
         self.entities = {}
 
 class legacy_entity:
+    __slots__ = ("id",)
 
     def __init__(self, entity_id):
         self.id = entity_id
 
-def locate_legacy(doc, topdir):
+class legacy_source:
+
+    #read the legacy Document folder, or its Document.zip archive in place when the folder was not extracted
+    def __init__(self, docdir):
+        self.docdir = docdir
+        self.zipname = docdir + ".zip"
+        self.archive = None
+        self.members = None
+        self.unsupported = set() #staging strategies that failed once
+        self.listings = {} #key: folder, value: set of the file names in it, each folder is listed once
+        if not os.path.isdir(docdir) and os.path.isfile(self.zipname):
+            self.archive = zipfile.ZipFile(self.zipname)
+            self.members = set(self.archive.namelist())
+
+    #archive member name of a path under the Document folder
+    def member(self, file_name):
+        return os.path.relpath(file_name, self.docdir).replace(os.sep, "/")
+
+    def open(self, file_name):
+        if self.archive is None:
+            return open(file_name, 'rb')
+        return self.archive.open(self.member(file_name))
+
+    #names of the files in folder, listed once, empty when the folder does not exist
+    #the listings of an archive are keyed by member folder and made for all folders at once
+    def listdir(self, folder):
+        if self.archive is not None:
+            return self.archive_listings().get(self.member(folder), set())
+        if folder not in self.listings:
+            try:
+                self.listings[folder] = set(os.listdir(folder))
+            except OSError:
+                self.listings[folder] = set()
+        return self.listings[folder]
+
+    #key: archive folder, value: set of the file names in it, made from the archive member names once
+    def archive_listings(self):
+        if not self.listings:
+            for name in self.members:
+                folder, sep, base = name.rpartition("/")
+                if base:
+                    self.listings.setdefault(folder, set()).add(base)
+        return self.listings
+
+    def copy(self, file_name, target_file):
+        if self.archive is None:
+            copyfile(file_name, target_file)
+        else:
+            with self.archive.open(self.member(file_name)) as src, open(target_file, 'wb') as dst:
+                copyfileobj(src, dst, 1024 * 1024)
+
+    #put file_name at target_file with the first of strategies that works, returns the strategy used
+    #an existing target is removed first, so a hardlink or symlink to the source is never written through
+    def stage(self, file_name, target_file, strategies):
+        if self.archive is not None:
+            strategies = ["copy"] #archive members can only be copied
+        for strategy in strategies:
+            if strategy in self.unsupported:
+                continue
+            try:
+                if os.path.lexists(target_file):
+                    os.remove(target_file)
+                if strategy == "hardlink":
+                    os.link(file_name, target_file)
+                elif strategy == "symlink":
+                    os.symlink(os.path.abspath(file_name), target_file)
+                elif strategy == "reflink":
+                    reflink_file(file_name, target_file)
+                else:
+                    self.copy(file_name, target_file)
+                return strategy
+            except OSError:
+                if strategy == "copy":
+                    raise
+                self.unsupported.add(strategy) #e.g. another device or file system, not tried again for this source
+        raise ValueError("no image staging strategy in " + str(strategies))
+
+    #True when target_file is missing, has another size or is older than the source file
+    def changed(self, file_name, target_file):
+        if not os.path.isfile(target_file):
+            return True
+        target = os.stat(target_file)
+        if self.archive is None:
+            source = os.stat(file_name)
+            size, mtime = source.st_size, source.st_mtime
+        else:
+            info = self.archive.getinfo(self.member(file_name))
+            size, mtime = info.file_size, time.mktime(info.date_time + (0, 0, -1))
+        return size != target.st_size or mtime > target.st_mtime
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+class legacy_page:
+
+    def __init__(self, number):
+        self.number = number
+        self.meta = None #(PAGE_HEIGHT, PAGE_WIDTH) from XMD-PAGE/Meta
+        self.content_primitives = [] #ids of all primitives, in file order
+        self.primitives = [] #(id, SEQ_NO, ELEMENT_TYPE, region coordinates), in file order
+        self.lines = [] #(line id, index in region, line coordinates) of the Arxxx.xml files read for the page
+        self.error = None #exception that stopped reading the page, if any
+
+class legacy_toc:
+
+    #read TOC.xml in a single streaming pass
+    def __init__(self, tocfile):
+        self.sourcefile = tocfile
+        self.release_no = None #Xmd_toc RELEASE_NO
+        self.resolutions = [] #Resolution texts
+        self.pages = [] #(PAGE_NO, ID) of every Page
+        self.entities = [] #(ID, PAGE_NO, FIRST_TOC_ENTRY_ID) of every Entity
+        self.body_entities = [] #(ID, FIRST_TOC_ENTRY_ID) of Body_np/Section/Page/Entity
+        self.toc_entries = [] #attributes of Logic_np/TOC_Entries/TOC_Entry
+        self.article_types = {} #key: TOC_ENTRY_ID, value: AR or AD
+        self.link = {} #attributes of the last Link element
+        path = []
+        for event, elem in etree.iterparse(tocfile, events=("start", "end")):
+            if event == "start":
+                path.append(elem.tag)
+                if elem.tag == "Xmd_toc" and self.release_no is None:
+                    self.release_no = elem.get("RELEASE_NO")
+                elif elem.tag == "Page":
+                    self.pages.append((elem.get("PAGE_NO"), elem.get("ID")))
+                elif elem.tag == "Entity":
+                    self.entities.append((elem.get("ID"), elem.get("PAGE_NO"), elem.get("FIRST_TOC_ENTRY_ID")))
+                    if path[1:] == ["Body_np", "Section", "Page", "Entity"]:
+                        self.body_entities.append((elem.attrib["ID"], elem.attrib["FIRST_TOC_ENTRY_ID"]))
+                elif elem.tag == "TOC_Entry" and path[1:] == ["Logic_np", "TOC_Entries", "TOC_Entry"]:
+                    entry = dict(elem.attrib)
+                    self.toc_entries.append(entry)
+                    self.article_types[entry["TOC_ENTRY_ID"]] = entry["PRIM_ID_REF"][0:2]
+                elif elem.tag == "Link":
+                    self.link = dict(elem.attrib)
+            else:
+                if elem.tag == "Resolution":
+                    self.resolutions.append(elem.text)
+                path.pop()
+                if len(path) > 0:
+                    elem.clear()
+        self.title = "unknown title" #Link SOURCE without extension
+        if "SOURCE" in self.link:
+            self.title = self.link["SOURCE"][:-4]
+
+FICLONE = 0x40049409 #linux ioctl sharing the data blocks of a file on copy-on-write file systems (btrfs, xfs)
+
+def reflink_file(src, dst):
+    if fcntl is None:
+        raise OSError("reflink is not supported on this platform")
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+class legacy_index:
+
+    #SQLite index of the TOC files under topdir, key: RELEASE_NO, doc title or Link title, value: TOC file path
+    #misses keeps the strings a full search did not find, with the indexed_ns of the newest TOC file searched
+    def __init__(self, indexfile, topdir):
+        self.indexfile = indexfile
+        self.topdir = topdir
+        folder = os.path.dirname(indexfile)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.toc_files = [] #TOC file paths found by the last update, in os.walk order
+        self.db = sqlite3.connect(indexfile)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != LEGACY_INDEX_VERSION:
+            with self.db:
+                for table in ["tocs", "toc_keys", "misses"]:
+                    self.db.execute("DROP TABLE IF EXISTS " + table)
+                self.db.execute("PRAGMA user_version = %d" % LEGACY_INDEX_VERSION)
+        self.db.execute("CREATE TABLE IF NOT EXISTS tocs (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, indexed_ns INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS toc_keys (key TEXT, path TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS misses (key TEXT PRIMARY KEY, searched_ns INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS toc_keys_key ON toc_keys (key)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS toc_keys_path ON toc_keys (path)")
+
+    #read the new and changed TOC files with a thread pool and forget the removed ones, returns the number of files read
+    #the folders are listed again only where their mtime changed, see find_sub_folders_with_toc_file
+    def update(self, workers=8):
+        known = {}
+        for path, mtime, size in self.db.execute("SELECT path, mtime_ns, size FROM tocs"):
+            known[path] = (mtime, size)
+        current = {} #in os.walk order
+        for path in find_toc_files(self.topdir, os.path.splitext(self.indexfile)[0] + "_folders.json"):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            current[path] = (stat.st_mtime_ns, stat.st_size)
+        changed = [path for path in current if known.get(path) != current[path]]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            keys = list(executor.map(legacy_toc_keys, changed))
+        indexed = time.time_ns()
+        with self.db:
+            for path in set(known) - set(current):
+                self.db.execute("DELETE FROM tocs WHERE path = ?", (path,))
+                self.db.execute("DELETE FROM toc_keys WHERE path = ?", (path,))
+            for path, path_keys in zip(changed, keys):
+                self.db.execute("INSERT OR REPLACE INTO tocs VALUES (?, ?, ?, ?)", (path,) + current[path] + (indexed,))
+                self.db.execute("DELETE FROM toc_keys WHERE path = ?", (path,))
+                self.db.executemany("INSERT INTO toc_keys VALUES (?, ?)", [(key, path) for key in path_keys])
+        self.toc_files = list(current)
+        return len(changed)
+
+    #first TOC file holding the string doc in os.walk order, None when there is none, call after update
+    #only the files indexed since the last search that missed doc are read, a miss is recorded for the next search
+    def search(self, doc):
+        row = self.db.execute("SELECT searched_ns FROM misses WHERE key = ?", (doc,)).fetchone()
+        searched = row[0] if row is not None else -1
+        indexed_ns = dict(self.db.execute("SELECT path, indexed_ns FROM tocs WHERE indexed_ns > ?", (searched,)))
+        bytespub = bytes(doc, 'utf-8')
+        newest = searched
+        for path in self.toc_files:
+            indexed = indexed_ns.get(path)
+            if indexed is None:
+                continue
+            try:
+                with open(path, 'rb', 0) as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as s:
+                    if s.find(bytespub) != -1:
+                        return path
+            except (OSError, ValueError):
+                continue #removed since the update, or empty
+            newest = max(newest, indexed)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO misses VALUES (?, ?)", (doc, newest))
+        return None
+
+    #TOC.xml path indexed for key, None when it is not indexed or the file changed since
+    def lookup(self, key):
+        row = self.db.execute("SELECT t.path, t.mtime_ns, t.size FROM toc_keys k JOIN tocs t ON t.path = k.path "
+                              "WHERE k.key = ? ORDER BY t.path LIMIT 1", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            stat = os.stat(row[0])
+        except OSError:
+            return None
+        if (stat.st_mtime_ns, stat.st_size) != (row[1], row[2]):
+            return None
+        return row[0]
+
+    def close(self):
+        self.db.close()
+
+#index keys of a TOC.xml file: RELEASE_NO, doc title as in Document.read_legacy_meta, and Link title
+def legacy_toc_keys(tocfile):
+    try:
+        toc = legacy_toc(tocfile)
+    except Exception as e:
+        print("Warning unreadable TOC file " + tocfile + ", not indexed")
+        print (e)
+        return []
+    keys = []
+    if toc.release_no:
+        keys.append(toc.release_no)
+        release_parts = toc.release_no.split("-")
+        if len(release_parts) >= 5:
+            keys.append(release_parts[1] + "-"+ release_parts[2] +"-"+ release_parts[3] +"-"+ release_parts[4])
+    if "SOURCE" in toc.link:
+        keys.append(toc.title)
+    return list(dict.fromkeys(keys))
+
+#TOC file of doc under topdir
+#with indexfile, RELEASE_NO, doc titles and Link titles are answered from a legacy_index, updated when doc is missing from it
+#other strings are searched in the indexed TOC files, a string not found is searched again only in TOC files changed since
+#without indexfile, every TOC file is searched
+def locate_legacy(doc, topdir, indexfile=None, workers=8):
+    if indexfile is not None:
+        index = legacy_index(indexfile, topdir)
+        try:
+            fullname = index.lookup(doc)
+            if fullname is None:
+                index.update(workers)
+                fullname = index.lookup(doc) or index.search(doc)
+            return fullname
+        finally:
+            index.close()
     bytespub = bytes(doc, 'utf-8')
     for root, dirs, files in os.walk(topdir):
         for fname in files:
@@ -742,3 +1400,163 @@ def locate_legacy(doc, topdir):
                 with open(fullname, 'rb', 0) as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as s:
                     if s.find(bytespub) != -1:
                         return fullname
+
+#folders holding a TOC.xml under dir_path, in os.walk order
+#Img folders, the Document folder next to a TOC.xml and the pipeline output folders of dir_path are not listed
+#indexfile keeps every listed folder with its mtime, a rescan lists again only the folders whose mtime changed
+def find_sub_folders_with_toc_file(dir_path, indexfile=None):
+    return [folder for folder, listing in scan_issue_folders(dir_path, indexfile).items() if listing[1]]
+
+#files named like a TOC file (ending with TOC.xml, in any case) under dir_path, in the folders find_sub_folders_with_toc_file scans
+def find_toc_files(dir_path, indexfile=None):
+    return [os.path.join(folder, name) for folder, listing in scan_issue_folders(dir_path, indexfile).items() for name in listing[3]]
+
+#listings of the folders under dir_path, in os.walk order, see list_issue_folder
+def scan_issue_folders(dir_path, indexfile=None):
+    index = load_issue_index(indexfile, dir_path)
+    folders = {} #key: folder, value: [mtime_ns, has TOC.xml, sub folders to scan, TOC file names]
+    pending = [dir_path]
+    while pending:
+        folder = pending.pop()
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            continue
+        listing = index.get(folder)
+        if listing is None or listing[0] != mtime:
+            listing = list_issue_folder(folder, mtime, folder == dir_path)
+        folders[folder] = listing
+        for name in reversed(listing[2]):
+            pending.append(os.path.join(folder, name))
+    if indexfile is not None:
+        save_issue_index(indexfile, dir_path, folders)
+    return folders
+
+def list_issue_folder(folder, mtime, top=False):
+    has_toc = False
+    subdirs = []
+    tocs = []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.name.upper().endswith("TOC.XML"):
+                    tocs.append(entry.name)
+                    has_toc = has_toc or entry.name == "TOC.xml"
+    except OSError as e:
+        print("ERROR in list_issue_folder " + folder)
+        print (e)
+        print ("END ERROR \n\n")
+    pruned = ["Img"]
+    if has_toc:
+        pruned.append("Document")
+    if top:
+        pruned.extend(PIPELINE_OUTPUT_DIRS)
+    return [mtime, has_toc, [name for name in subdirs if name not in pruned], sorted(tocs)]
+
+#folder listings of a previous scan of dir_path, listings too close to the save time are dropped, their folder may have changed in the same mtime tick
+def load_issue_index(indexfile, dir_path):
+    if indexfile is None or not os.path.isfile(indexfile):
+        return {}
+    try:
+        with open(indexfile) as f:
+            index = json.load(f)
+        if index["version"] != ISSUE_INDEX_VERSION or index["root"] != os.path.abspath(dir_path):
+            return {}
+        recent = index["saved_ns"] - 2 * 10 ** 9
+        return dict((folder, listing) for folder, listing in index["folders"].items() if listing[0] < recent)
+    except Exception as e:
+        print("Warning unreadable issue index " + indexfile + ", scanning all folders")
+        print (e)
+        return {}
+
+def save_issue_index(indexfile, dir_path, folders):
+    try:
+        if os.path.dirname(indexfile) and not os.path.isdir(os.path.dirname(indexfile)):
+            os.makedirs(os.path.dirname(indexfile))
+        index = {"version": ISSUE_INDEX_VERSION, "root": os.path.abspath(dir_path), "saved_ns": time.time_ns(), "folders": folders}
+        with open(indexfile + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(indexfile + ".tmp", indexfile)
+    except Exception as e:
+        print("ERROR in save_issue_index " + indexfile)
+        print (e)
+        print ("END ERROR \n\n")
+
+#reset the peak RSS of the process (Linux), returns False when it can not be reset
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+#peak RSS in MB since the last reset_peak_rss, or of the whole process where it can not be reset
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+#data segment size of the process in bytes (VmData), the size RLIMIT_DATA is checked against
+def data_size_bytes():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmData:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+#run action(document, folder) on every folder with a new Document, closed before the next folder
+#memory_budget_mb caps what an issue may add to the process data size (RLIMIT_DATA over the size before the issue),
+#an issue over the budget fails with MemoryError and the batch goes on
+#every folder is an issue of the stage recorder, its stage timings are written when the recorder is open
+#returns [(folder, action result or None, peak RSS in MB)]
+def process_legacy_issues(folders, action, memory_budget_mb=None):
+    results = []
+    for folder in folders:
+        p = Document()
+        limits = None
+        reset_peak_rss()
+        recorder.start_issue(folder)
+        try:
+            if memory_budget_mb is not None and resource is not None:
+                limits = resource.getrlimit(resource.RLIMIT_DATA)
+                budget = (data_size_bytes() or 0) + int(memory_budget_mb * 1024 * 1024)
+                if limits[1] != resource.RLIM_INFINITY:
+                    budget = min(budget, limits[1])
+                resource.setrlimit(resource.RLIMIT_DATA, (budget, limits[1]))
+            result = action(p, folder)
+        except MemoryError:
+            print("ERROR in process_legacy_issues, " + folder + " is over the memory budget of " + str(memory_budget_mb) + " MB")
+            result = None
+        except Exception as e:
+            print("ERROR in process_legacy_issues for " + folder)
+            print (e)
+            print ("END ERROR \n\n")
+            result = None
+        finally:
+            if limits is not None:
+                resource.setrlimit(resource.RLIMIT_DATA, limits)
+            p.close()
+            p = None
+            gc.collect()
+        peak = peak_rss_mb()
+        recorder.end_issue(peak_rss_mb=peak)
+        if peak is not None:
+            print("{}: peak RSS {:.1f} MB".format(folder, peak))
+        results.append((folder, result, peak))
+    return results
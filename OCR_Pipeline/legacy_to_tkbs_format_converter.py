@@ -1,6 +1,11 @@
-import os, shutil
+import os, time, json
 from pathlib import Path
-from TkbsDocument import Document
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from TkbsDocument import Document, find_sub_folders_with_toc_file, reset_peak_rss, peak_rss_mb
+
+CONVERTER_VERSION = 1 # bump when the converted output changes, every issue is then converted again
+MANIFEST_NAME = "legacy_manifest.json" # written in each output folder, describes the input it was converted from
 
 
 def get_path_from_user():
@@ -18,13 +23,26 @@ def get_path_from_user():
         print("Illegal path, try again")
         return ""
 
-def find_sub_folders_with_toc_file(dir_path):  # Get absolute path
-    sub_folders_with_TOC_file = []
-    for subdir, dirs, files in os.walk(dir_path):
-        for file in files:
-            if file == "TOC.xml":
-                sub_folders_with_TOC_file.append(subdir)
-    return sub_folders_with_TOC_file
+def get_workers_from_user():
+    default_workers = os.cpu_count() or 1
+    user_input = input("Enter the number of issues to convert in parallel (or press Enter for " + str(default_workers) + "): ")
+    if user_input.strip() == "":
+        return default_workers
+    try:
+        return max(1, int(user_input))
+    except ValueError:
+        print("Illegal number, converting one issue at a time")
+        return 1
+
+def get_image_staging_from_user():
+    strategies = Document().image_staging_fallback
+    user_input = input("Enter how to put the page images in the output: hardlink, reflink, symlink or copy (or press Enter for hardlink): ")
+    if user_input.strip() == "":
+        return "hardlink"
+    if user_input.strip().lower() in strategies:
+        return user_input.strip().lower()
+    print("Illegal choice, copying the images")
+    return "copy"
 
 
 def create_unique_output_folder(dir_path):
@@ -35,26 +53,172 @@ def create_unique_output_folder(dir_path):
     return output_path
 
 
+# existing output folders are kept, unchanged issues are skipped and changed ones rewritten in place
 def create_sub_folders_in_output_folder(folders_to_be_converted, inpath, outpath):
     output_sub_folders = []
     for folder in folders_to_be_converted:
         to_create = folder.replace(inpath, outpath)
-        if os.path.isdir(to_create):
-            shutil.rmtree(to_create)
         path = Path(to_create)
-        path.mkdir(parents=True)
+        path.mkdir(parents=True, exist_ok=True)
         output_sub_folders.append(to_create)
     return output_sub_folders
 
 
-def convert_legacy_folder_to_tkbs_format(src_path, dst_path):
+def read_issue_manifest(dst_path):
+    manifest_file = os.path.join(dst_path, MANIFEST_NAME)
+    if not os.path.isfile(manifest_file):
+        return None
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except Exception as e:
+        print("Warning unreadable manifest " + manifest_file)
+        print(e)
+        return None
+
+
+def write_issue_manifest(dst_path, manifest):
+    manifest_file = os.path.join(dst_path, MANIFEST_NAME)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+# converter version, Document settings, image staging and input fingerprint (size and mtime of TOC.xml and the Document files)
+def issue_manifest_key(p, src_path):
+    return {"converter_version": CONVERTER_VERSION,
+            "settings": list(p.legacy_snapshot_settings()),
+            "staging": p.image_staging,
+            "fingerprint": [list(entry) for entry in p.legacy_fingerprint(src_path, images=True)]}
+
+
+# page count of the issue when dst_path holds a complete conversion of the unchanged src_path, None otherwise
+def unchanged_issue_pages(src_path, dst_path, staging="copy"):
+    manifest = read_issue_manifest(dst_path)
+    if manifest is None:
+        return None
+    p = Document()
+    p.image_staging = staging
+    key = issue_manifest_key(p, src_path)
+    for name in key:
+        if manifest.get(name) != key[name]:
+            return None
+    for output in manifest.get("outputs", []):
+        if not os.path.isfile(os.path.join(dst_path, output)):
+            return None
+    return manifest.get("pages")
+
+
+# returns the number of converted pages, None if the conversion failed or a page could not be read or written
+# with manifest=True the output folder manifest is updated, and files of the previous conversion that are not written any more are removed
+def convert_legacy_folder_to_tkbs_format(src_path, dst_path, cachedir=None, manifest=False, staging="copy"):
+    p = Document()
     try:
-        p = Document()
-        p.load_legacy_data(src_path)
-        p.export_tkbs_format(dst_path)
+        p.image_staging = staging
+        if manifest:
+            key = issue_manifest_key(p, src_path) # taken before reading, a file changed meanwhile is converted again next time
+            previous = read_issue_manifest(dst_path)
+        p.load_legacy_data(src_path, cachedir=cachedir)
+        if p.page_count == 0:
+            return None
+        p.export_tkbs_format(dst_path, release_pages=True)
+        if p.errors: # no manifest, so the issue is converted again next time
+            return None
+        if manifest:
+            outputs = sorted([os.path.basename(name) for name in p.PagesImgName.values()] + list(p.pxmlOutname.values()))
+            if previous is not None:
+                for output in set(previous.get("outputs", [])) - set(outputs):
+                    if os.path.isfile(os.path.join(dst_path, output)):
+                        os.remove(os.path.join(dst_path, output))
+            key["outputs"] = outputs
+            key["pages"] = p.page_count
+            write_issue_manifest(dst_path, key)
+        return p.page_count
     except Exception as e:
         print("ERROR in convert_legacy_folder_to_tkbs_format with src_path " + src_path)
         print(e)
+        return None
+    finally:
+        p.close()
+
+
+# (src_path, page count or None, seconds, skipped, peak RSS in MB or None), runs in the worker processes
+# the Document loaders sys.exit on a broken TOC.xml, this stops only the issue and not the batch
+# with incremental=True an issue whose manifest matches its input is skipped
+def convert_and_time(src_path, dst_path, cachedir=None, incremental=False, staging="copy"):
+    start = time.perf_counter()
+    reset_peak_rss()
+    try:
+        if incremental:
+            pages = unchanged_issue_pages(src_path, dst_path, staging)
+            if pages is not None:
+                return src_path, pages, time.perf_counter() - start, True, peak_rss_mb()
+        pages = convert_legacy_folder_to_tkbs_format(src_path, dst_path, cachedir, incremental, staging)
+    except SystemExit:
+        pages = None
+    return src_path, pages, time.perf_counter() - start, False, peak_rss_mb()
+
+
+def print_issue_throughput(result):
+    src_path, pages, seconds, skipped, peak = result
+    rss = "" if peak is None else ", peak RSS {:.1f} MB".format(peak)
+    if skipped:
+        print("Unchanged {}: {} pages, skipped{}".format(src_path, pages, rss))
+    elif pages is None:
+        print("FAILED {} after {:.2f}s{}".format(src_path, seconds, rss))
+    else:
+        print("Converted {}: {} pages in {:.2f}s ({:.1f} pages/s{})".format(src_path, pages, seconds, pages / max(seconds, 1e-9), rss))
+
+
+# converts (src_path, dst_path) issues in a process pool, appends their results
+# returns the issues lost with a crashed worker process when retry is True, they are reported as failed otherwise
+def convert_in_pool(issues, workers, cachedir, results, retry=True, incremental=False, staging="copy"):
+    broken = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for src_path, dst_path in issues:
+            futures[executor.submit(convert_and_time, src_path, dst_path, cachedir, incremental, staging)] = (src_path, dst_path)
+        for future in as_completed(futures):
+            src_path = futures[future][0]
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                if retry:
+                    broken.append(futures[future])
+                    continue
+                print("ERROR worker process crashed with src_path " + src_path)
+                result = (src_path, None, 0.0, False, None)
+            except Exception as e:
+                print("ERROR in worker process with src_path " + src_path)
+                print (e)
+                print ("END ERROR \n\n")
+                result = (src_path, None, 0.0, False, None)
+            results.append(result)
+            print_issue_throughput(result)
+    return broken
+
+
+# converts every folder, workers > 1 converts the issues in a process pool
+# a failed issue is reported and skipped, the other issues are still converted
+# issues lost with a crashed worker process are converted again, each in its own process
+def convert_folders(folders_to_be_converted, output_sub_folders, workers=1, cachedir=None, incremental=False, staging="copy"):
+    results = []
+    start = time.perf_counter()
+    issues = list(zip(folders_to_be_converted, output_sub_folders))
+    if workers <= 1:
+        for src_path, dst_path in issues:
+            results.append(convert_and_time(src_path, dst_path, cachedir, incremental, staging))
+            print_issue_throughput(results[-1])
+    else:
+        for issue in convert_in_pool(issues, workers, cachedir, results, incremental=incremental, staging=staging):
+            convert_in_pool([issue], 1, cachedir, results, retry=False, incremental=incremental, staging=staging)
+    elapsed = time.perf_counter() - start
+    converted = [pages for src_path, pages, seconds, skipped, peak in results if pages is not None and not skipped]
+    unchanged = len([result for result in results if result[3]])
+    print("{} issues ({} pages) converted, {} unchanged, {} failed, in {:.2f}s with {} workers: {:.2f} issues/s, {:.1f} pages/s".format(
+        len(converted), sum(converted), unchanged, len(results) - len(converted) - unchanged, elapsed, workers,
+        len(converted) / max(elapsed, 1e-9), sum(converted) / max(elapsed, 1e-9)))
+    return results
 
 
 def main():
@@ -62,23 +226,20 @@ def main():
     while path == "":
         path = get_path_from_user()
         
+    workers = get_workers_from_user()
+    staging = get_image_staging_from_user()
     output_dir = create_unique_output_folder(path)
+    snapshot_dir = os.path.join(path, "legacy_snapshots") # parsed issues, reused by the uploader and exporter
 
-    folders_to_be_converted = find_sub_folders_with_toc_file(path)
+    folders_to_be_converted = find_sub_folders_with_toc_file(path, os.path.join(snapshot_dir, "issue_index.json"))
     output_sub_folders = create_sub_folders_in_output_folder(folders_to_be_converted, path, output_dir)
 
-    for f in range(len(
-            folders_to_be_converted)):  # The routine that take source folder and convert files into destination file
-        try:
-            convert_legacy_folder_to_tkbs_format(folders_to_be_converted[f], output_sub_folders[f])
-        except Exception as e:
-            print("ERROR in main loop")
-            print (e)
-            print ("END ERROR \n\n")
-            continue
-            
+    # The routine that take source folder and convert files into destination file
+    results = convert_folders(folders_to_be_converted, output_sub_folders, workers, snapshot_dir, incremental=True, staging=staging)
+    converted = len([pages for src_path, pages, seconds, skipped, peak in results if pages is not None])
+
     print("{} files converted successfully from legacy format to Transkribus format.\n"
-          " You can find them now in {}'.".format(len(folders_to_be_converted), output_dir))
+          " You can find them now in {}'.".format(converted, output_dir))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,105 @@
+# Scaling benchmark of the Document stages on synthetic Olive issues, not collected by the test runner
+# run from the OCR_Pipeline folder:  python tests/document_benchmark.py --scale pages --sizes 4 8 16 32
+# every stage is timed on issues of growing size, and the growth exponent between the smallest and largest
+# size is reported: about 1 is linear, about 2 is quadratic. The exit code is 1 when a stage grows faster than --max-slope
+
+import os
+import sys
+import time
+import math
+import shutil
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from TkbsDocument import Document
+from synthetic_issue import write_synthetic_issue, write_synthetic_tkbs_folder
+
+STAGES = ["load_legacy_data", "export_tkbs_format", "load_tkbs_data", "match_legacy_articles", "export_tei"]
+DEFAULTS = {"pages": 4, "entities": 8, "primitives": 4, "lines": 3}
+
+
+# seconds of every stage on one issue, the best of `repeat` runs
+def time_issue(work_dir, size_args, repeat):
+    src = os.path.join(work_dir, "issue")
+    write_synthetic_issue(src, **size_args)
+    best = dict((stage, float("inf")) for stage in STAGES)
+    for run in range(repeat):
+        run_dir = os.path.join(work_dir, "run" + str(run))
+        converted = os.path.join(run_dir, "converted")
+        tei = os.path.join(run_dir, "tei")
+        os.makedirs(tei)
+        p = Document()
+        timings = {}
+        start = time.perf_counter()
+        p.load_legacy_data(src)
+        timings["load_legacy_data"] = time.perf_counter() - start
+        start = time.perf_counter()
+        p.export_tkbs_format(converted)
+        timings["export_tkbs_format"] = time.perf_counter() - start
+        tkbs = write_synthetic_tkbs_folder(p, converted, os.path.join(run_dir, "tkbs"), lines=size_args["lines"])
+        start = time.perf_counter()
+        p.load_tkbs_data(tkbs)
+        timings["load_tkbs_data"] = time.perf_counter() - start
+        start = time.perf_counter()
+        p.match_legacy_articles()
+        timings["match_legacy_articles"] = time.perf_counter() - start
+        start = time.perf_counter()
+        p.export_tei(tei)
+        timings["export_tei"] = time.perf_counter() - start
+        p.close()
+        shutil.rmtree(run_dir)
+        for stage in STAGES:
+            best[stage] = min(best[stage], timings[stage])
+    shutil.rmtree(src)
+    return best
+
+
+# growth exponent of seconds against size between the first and the last point
+def scaling_slope(sizes, seconds):
+    if sizes[0] == sizes[-1] or seconds[0] <= 0 or seconds[-1] <= 0:
+        return float("nan")
+    return math.log(seconds[-1] / seconds[0]) / math.log(float(sizes[-1]) / sizes[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling benchmark of the Document stages")
+    parser.add_argument("--scale", choices=sorted(DEFAULTS), default="pages", help="issue dimension that grows")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[4, 8, 16, 32], help="values of the growing dimension")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per size, the fastest is kept")
+    parser.add_argument("--max-slope", type=float, default=1.5, help="growth exponent above which a stage is flagged")
+    for name, value in sorted(DEFAULTS.items()):
+        parser.add_argument("--" + name, type=int, default=value, help="fixed %s when it is not the growing dimension" % name)
+    args = parser.parse_args()
+
+    results = {}
+    work_dir = tempfile.mkdtemp()
+    try:
+        for size in args.sizes:
+            size_args = dict((name, getattr(args, name)) for name in DEFAULTS)
+            size_args[args.scale] = size
+            results[size] = time_issue(os.path.join(work_dir, str(size)), size_args, args.repeat)
+    finally:
+        shutil.rmtree(work_dir)
+
+    print("%-10s" % args.scale + "".join("%24s" % stage for stage in STAGES))
+    for size in args.sizes:
+        print("%-10d" % size + "".join("%21.2f ms" % (results[size][stage] * 1000) for stage in STAGES))
+    flagged = []
+    slopes = []
+    for stage in STAGES:
+        slope = scaling_slope(args.sizes, [results[size][stage] for size in args.sizes])
+        slopes.append(slope)
+        if slope > args.max_slope:
+            flagged.append(stage)
+    print("%-10s" % "slope" + "".join("%24.2f" % slope for slope in slopes))
+    if flagged:
+        print("SUPERLINEAR in " + args.scale + ": " + ", ".join(flagged))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,6 +5,7 @@ from unittest.mock import patch
 import os
 
 import legacy_to_tkbs_format_converter as fc
+from synthetic_issue import write_legacy_issue, WorkDirTestCase, TWO_PAGE_ISSUE
 
 
 class MyTestCase(unittest.TestCase):
@@ -90,10 +91,70 @@ class CreateOutputDirectory(unittest.TestCase):
         self.assertEqual(before_adding_output_sub_folders + num_of_toc_files, after_adding_output_sub_folders)
 
 
-class ConvertFormatFile(unittest.TestCase):
+class ConvertFormatFile(WorkDirTestCase):
     def test_something(self):
         pass
 
+    def test_parallel_conversion_isolates_failed_issue(self):
+        for name in ["issue1", "issue2"]:
+            write_legacy_issue(os.path.join(self.work_dir, "input", name), TWO_PAGE_ISSUE)
+        os.makedirs(os.path.join(self.work_dir, "input", "broken"))
+        with open(os.path.join(self.work_dir, "input", "broken", "TOC.xml"), "w") as f:
+            f.write("<Xmd_toc")
+        folders = sorted(fc.find_sub_folders_with_toc_file(os.path.join(self.work_dir, "input")))
+        outputs = {}
+        for workers in [1, 2]:
+            out_dir = os.path.join(self.work_dir, "output" + str(workers))
+            outputs[workers] = fc.create_sub_folders_in_output_folder(folders, os.path.join(self.work_dir, "input"), out_dir)
+            results = fc.convert_folders(folders, outputs[workers], workers)
+            self.assertEqual(sorted((os.path.basename(src), pages) for src, pages, seconds, skipped, peak in results),
+                             [("broken", None), ("issue1", 2), ("issue2", 2)])
+        for sequential, parallel in zip(outputs[1], outputs[2]):
+            self.assertEqual(sorted(os.listdir(sequential)), sorted(os.listdir(parallel)))
+            for name in os.listdir(sequential):
+                with open(os.path.join(sequential, name), "rb") as s, open(os.path.join(parallel, name), "rb") as p:
+                    self.assertEqual(s.read(), p.read())
+
+    def test_incremental_conversion_skips_unchanged_issues(self):
+        inpath = os.path.join(self.work_dir, "input")
+        for name in ["issue1", "issue2"]:
+            write_legacy_issue(os.path.join(inpath, name), TWO_PAGE_ISSUE)
+        folders = sorted(fc.find_sub_folders_with_toc_file(inpath))
+        outputs = fc.create_sub_folders_in_output_folder(folders, inpath, os.path.join(self.work_dir, "output"))
+        first = fc.convert_folders(folders, outputs, incremental=True)
+        self.assertEqual([skipped for src, pages, seconds, skipped, peak in first], [False, False])
+        second = fc.convert_folders(folders, outputs, incremental=True)
+        self.assertEqual([(pages, skipped) for src, pages, seconds, skipped, peak in second], [(2, True), (2, True)])
+
+        image = os.path.join(inpath, "issue1", "Document", "1", "Img", "Pg001_100.png")
+        with open(image, "wb") as f:
+            f.write(b"new png")
+        stat = os.stat(image)
+        os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        outputs = fc.create_sub_folders_in_output_folder(folders, inpath, os.path.join(self.work_dir, "output"))
+        third = fc.convert_folders(folders, outputs, incremental=True)
+        self.assertEqual([skipped for src, pages, seconds, skipped, peak in third], [False, True])
+        with open(os.path.join(outputs[0], "Pg001_100.png"), "rb") as f:
+            self.assertEqual(f.read(), b"new png")
+
+    def test_changed_staging_converts_again(self):
+        src = os.path.join(self.work_dir, "issue")
+        dst = os.path.join(self.work_dir, "output")
+        write_legacy_issue(src, TWO_PAGE_ISSUE)
+        self.assertEqual(fc.convert_legacy_folder_to_tkbs_format(src, dst, manifest=True, staging="hardlink"), 2)
+        self.assertEqual(fc.unchanged_issue_pages(src, dst, "hardlink"), 2)
+        self.assertIsNone(fc.unchanged_issue_pages(src, dst, "symlink"))
+
+    def test_issue_with_unreadable_page_gets_no_manifest(self):
+        src = os.path.join(self.work_dir, "issue")
+        dst = os.path.join(self.work_dir, "output")
+        write_legacy_issue(src, TWO_PAGE_ISSUE)
+        with open(os.path.join(src, "Document", "2", "Ar00201.xml"), "w") as f:
+            f.write("<Xmd_article")
+        self.assertIsNone(fc.convert_legacy_folder_to_tkbs_format(src, dst, manifest=True))
+        self.assertIsNone(fc.read_issue_manifest(dst))
+        self.assertIsNone(fc.unchanged_issue_pages(src, dst))
+
 
 if __name__ == '__main__':
     unittest.main()
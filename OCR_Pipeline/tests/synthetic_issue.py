@@ -0,0 +1,149 @@
+# Synthetic Olive issues, Transkribus download folders and a temporary folder test case, used by the tests and by document_benchmark.py
+
+import os
+import json
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+from lxml import etree
+
+PAGE_NS = "{http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15}"
+
+# smallest valid PNG, 1x1 gray pixel
+def tiny_png():
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(b"\x00\x80")) + chunk(b"IEND", b""))
+
+TINY_PNG = tiny_png()
+
+
+# page number -> list of (entity id, [(primitive suffix, SEQ_NO, ELEMENT_TYPE)])
+TWO_PAGE_ISSUE = {
+    1: [("Ar00101", [("01", 1, "Text"), ("02", 2, "Text"), ("03", 3, "HedLine_hl1")]),
+        ("Ar00102", [("01", 1, "HedLine_hl1"), ("02", 0, "HedLine_hl1"), ("03", 2, "Text")])],
+    2: [("Ar00201", [("01", 2, "Text"), ("02", 1, "Picture"), ("03", 3, "HedLine_hl1")]),
+        ("Ad00202", [("01", 1, "AdFrame"), ("02", 2, "Text")])],
+}
+
+
+# writes TOC.xml and Document/<page>/ Pgxxx.xml, Arxxx.xml / Adxxx.xml and Img/Pgxxx_<resolution>.png under root
+# pages is {page number: [(entity id, [(primitive suffix, SEQ_NO, ELEMENT_TYPE)])]}, the primitives of a page are
+# stacked from its top, every text primitive has `lines` lines, the TOC entry of an entity refers to its first primitive
+def write_legacy_issue(root, pages, resolution=100, release_no="021-HZF-1914-11-06-001-400797", lines=1):
+    toc = ['<Xmd_toc RELEASE_NO="%s">' % release_no,
+           '<Head_np><Link SOURCE="%s.pdf"/>' % release_no,
+           '<Resolution>%d</Resolution></Head_np>' % resolution,
+           '<Body_np><Section>']
+    toc_entries = []
+    height = 20 + lines * 20
+    for pgnum, entities in sorted(pages.items()):
+        pgid = "Pg%03d" % pgnum
+        pgdir = os.path.join(root, "Document", str(pgnum))
+        os.makedirs(os.path.join(pgdir, "Img"))
+        with open(os.path.join(pgdir, "Img", pgid + "_" + str(resolution) + ".png"), "wb") as f:
+            f.write(TINY_PNG)
+        toc.append('<Page PAGE_NO="%d" ID="%s">' % (pgnum, pgid))
+        page_height = 20 + sum(len(primitives) for entity, primitives in entities) * height
+        pgxml = ['<XMD-PAGE><Meta IMAGES_RESOLUTION="%d" PAGE_HEIGHT="%d" PAGE_WIDTH="1000"/><Content>' % (resolution, page_height)]
+        top = 10
+        for entity, primitives in entities:
+            toc_entries.append((entity, primitives[0][0]))
+            toc.append('<Entity ID="%s" PAGE_NO="%d" FIRST_TOC_ENTRY_ID="%d"/>' % (entity, pgnum, len(toc_entries)))
+            arxml = ['<XMD-entity><Content>']
+            for suffix, seq, kind in primitives:
+                pid = entity + suffix
+                pgxml.append('<Primitive ID="%s" SEQ_NO="%d" ELEMENT_TYPE="%s"/>' % (pid, seq, kind))
+                box = "%d %d %d %d" % (10, top, 900, top + height)
+                tag = "Img" if kind == "Picture" else "Primitive"
+                arxml.append('<%s ID="%s" BOX="%s">' % (tag, pid, box))
+                if tag == "Primitive":
+                    for line in range(lines):
+                        arxml.append('<L BOX="%d %d %d %d"/>' % (10, top + line * 20, 900, top + line * 20 + 18))
+                arxml.append('</%s>' % tag)
+                top += height
+            arxml.append('</Content></XMD-entity>')
+            with open(os.path.join(pgdir, entity + ".xml"), "w") as f:
+                f.write("".join(arxml))
+        pgxml.append('</Content></XMD-PAGE>')
+        with open(os.path.join(pgdir, pgid + ".xml"), "w") as f:
+            f.write("".join(pgxml))
+        toc.append('</Page>')
+    toc.append('</Section></Body_np><Logic_np><TOC_Entries>')
+    for count, (entity, suffix) in enumerate(toc_entries):
+        toc.append('<TOC_Entry TOC_ENTRY_ID="%d" TITLE="title %d" PRIM_ID_REF="%s%s" ENTITY_ID_REF="%s"/>'
+                   % (count + 1, count + 1, entity, suffix, entity))
+    toc.append('</TOC_Entries></Logic_np></Xmd_toc>')
+    with open(os.path.join(root, "TOC.xml"), "w") as f:
+        f.write("".join(toc))
+    return root
+
+
+# primitive (suffix, SEQ_NO, ELEMENT_TYPE) of an entity, one headline first, a picture in every 5th entity,
+# an AdFrame around every 4th entity which is then an advertisement
+def synthetic_primitives(entity_count, primitives):
+    kinds = []
+    if entity_count % 4 == 3:
+        kinds.append("AdFrame")
+    kinds.append("HedLine_hl1")
+    while len(kinds) < primitives:
+        kinds.append("Picture" if entity_count % 5 == 4 and len(kinds) == primitives - 1 else "Text")
+    return [("%02d" % (count + 1), count, kind) for count, kind in enumerate(kinds)]
+
+
+# write_legacy_issue of `pages` pages of `entities` entities of `primitives` primitives, see synthetic_primitives
+def write_synthetic_issue(root, pages=2, entities=4, primitives=4, lines=3, resolution=100,
+                          release_no="021-HZF-1914-11-06-001-400797"):
+    issue = {}
+    for pgnum in range(1, pages + 1):
+        issue[pgnum] = []
+        for entity_count in range(entities):
+            kinds = synthetic_primitives(entity_count, primitives)
+            prefix = "Ad" if kinds[0][2] == "AdFrame" else "Ar"
+            issue[pgnum].append(("%s%03d%02d" % (prefix, pgnum, entity_count + 1), kinds))
+    return write_legacy_issue(root, issue, resolution, release_no, lines)
+
+
+# writes a Transkribus download folder (trp.json, page images and pxml with recognized lines) for a Document
+# converted to converted_dir with export_tkbs_format, as load_tkbs_data reads it after OCR
+def write_synthetic_tkbs_folder(document, converted_dir, tkbs_dir, lines=3, doc_id=1000, col_id=100):
+    os.makedirs(tkbs_dir)
+    pages = []
+    for pgnum in sorted(document.pxmlOutname, key=int):
+        pxml = document.pxmlOutname[pgnum]
+        image = os.path.basename(document.PagesImgName[pgnum])
+        shutil.copyfile(os.path.join(converted_dir, image), os.path.join(tkbs_dir, image))
+        tree = etree.parse(os.path.join(converted_dir, pxml))
+        for region in tree.iter(PAGE_NS + "TextRegion"):
+            text_equiv = region.find(PAGE_NS + "TextEquiv")
+            region_lines = []
+            for line in range(lines):
+                line_id = region.get("id") + "l" + str(line + 1)
+                text = "line %d of %s" % (line + 1, region.get("id"))
+                region_lines.append(text)
+                text_line = etree.Element(PAGE_NS + "TextLine", {"id": line_id, "custom": "readingOrder {index:%d;}" % line})
+                etree.SubElement(text_line, PAGE_NS + "Coords", {"points": "10,%d 900,%d 900,%d 10,%d" % (line, line, line + 1, line + 1)})
+                etree.SubElement(etree.SubElement(text_line, PAGE_NS + "TextEquiv"), PAGE_NS + "Unicode").text = text
+                text_equiv.addprevious(text_line)
+            text_equiv.find(PAGE_NS + "Unicode").text = "\n".join(region_lines)
+        tree.write(os.path.join(tkbs_dir, pxml), encoding="UTF-8", xml_declaration=True)
+        pages.append({"pageNr": int(pgnum), "pageId": doc_id * 1000 + int(pgnum), "imgFileName": image,
+                      "tsList": {"transcripts": [{"toolName": "synthetic"}]}})
+    trp = {"md": {"title": document.title, "docId": doc_id},
+           "collection": {"colId": col_id, "colName": "synthetic"},
+           "pageList": {"pages": pages}}
+    with open(os.path.join(tkbs_dir, document.tkbs_meta_filename), "w") as f:
+        json.dump(trp, f)
+    return tkbs_dir
+
+
+# test case with a new temporary folder in self.work_dir for every test, removed after it
+class WorkDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
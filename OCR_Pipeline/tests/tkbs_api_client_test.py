@@ -0,0 +1,335 @@
+# These tests run the client against a small local HTTP server, no Transkribus account is needed
+
+import unittest
+import os
+import json
+import re
+import email
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from TkbsApiClient import TranskribusClient, MultipartStream
+from synthetic_issue import WorkDirTestCase
+
+
+class FakeTranskribus(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+    routes = {} # key: (method, path), value: (status, content type, body bytes) or a function of the request body giving it
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self.server.requests.append((self.command, self.path, self.client_address[1], self.headers.get("Cookie"), body))
+        route = self.routes.get((self.command, self.path.split("?")[0]), (404, "text/plain", b"not found"))
+        status, content_type, data = route(body) if callable(route) else route
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = respond
+
+
+def start_fake_server(routes):
+    handler = type("Handler", (FakeTranskribus,), {"routes": routes})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.requests = []
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    return server, "http://127.0.0.1:%d/TrpServer" % server.server_address[1]
+
+
+class PooledSession(unittest.TestCase):
+    def setUp(self):
+        self.server, self.url = start_fake_server({("GET", "/TrpServer/rest/jobs/7"): (200, "application/json", b'{"state": "FINISHED"}')})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_requests_reuse_one_connection(self):
+        with TranskribusClient(sServerUrl=self.url) as client:
+            client.setSessionId("abc")
+            for count in range(5):
+                self.assertEqual(client.getJobStatus(7)["state"], "FINISHED")
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(set(port for method, path, port, cookie, body in self.server.requests)), 1)
+        self.assertEqual(set(cookie for method, path, port, cookie, body in self.server.requests), {"JSESSIONID=abc"})
+
+    def test_without_keep_alive_every_request_connects(self):
+        client = TranskribusClient(sServerUrl=self.url, bKeepAlive=False)
+        client.setSessionId("abc")
+        for count in range(3):
+            client.getJobStatus(7)
+        client.close()
+        self.assertEqual(len(set(port for method, path, port, cookie, body in self.server.requests)), 3)
+
+    def test_threads_share_the_pool(self):
+        client = TranskribusClient(sServerUrl=self.url, iPoolSize=2)
+        client.setSessionId("abc")
+        threads = [threading.Thread(target=client.getJobStatus, args=(7,)) for count in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        client.close()
+        self.assertEqual(len(self.server.requests), 8)
+        self.assertTrue(len(set(port for method, path, port, cookie, body in self.server.requests)) <= 2)
+
+
+# trp.json of a document of `pages` pages served by the fake server at url, with the routes of its images and page XML
+def fake_document(url, pages, col_id=1, doc_id=2):
+    routes = {}
+    trp_pages = []
+    for pgnum in range(1, pages + 1):
+        image = "/TrpServer/files/img%d" % pgnum
+        xml = "/TrpServer/files/xml%d" % pgnum
+        routes[("GET", image)] = (200, "image/png", bytes([pgnum]) * (3000 + pgnum))
+        routes[("GET", xml)] = (200, "application/xml", ("<PcGts>page %d \u05d0</PcGts>" % pgnum).encode("utf-8"))
+        trp_pages.append({"pageNr": pgnum, "pageId": 100 + pgnum, "imgFileName": "Pg%03d_100.png" % pgnum,
+                          "url": url.replace("/TrpServer", "") + image,
+                          "tsList": {"transcripts": [{"timestamp": 1000 + pgnum, "url": url.replace("/TrpServer", "") + xml}]}})
+    trp = {"md": {"docId": doc_id, "title": "doc"}, "collection": {"colId": col_id}, "pageList": {"pages": trp_pages}}
+    routes[("GET", "/TrpServer/rest/collections/%d/%d/fulldoc" % (col_id, doc_id))] = (200, "application/json", json.dumps(trp).encode("utf-8"))
+    return routes
+
+
+class DocumentDownload(WorkDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.routes = {}
+        self.server, self.url = start_fake_server(self.routes)
+        self.routes.update(fake_document(self.url, 6))
+        self.client = TranskribusClient(sServerUrl=self.url)
+        self.client.setSessionId("abc")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def download(self, name, **kwargs):
+        folder = os.path.join(self.work_dir, name)
+        result = self.client.download_document(1, 2, folder, **kwargs)
+        files = {}
+        for file_name in sorted(os.listdir(folder)):
+            with open(os.path.join(folder, file_name), "rb") as f:
+                files[file_name] = f.read()
+        return result, files
+
+    def test_parallel_download_matches_sequential(self):
+        sequential = self.download("sequential")
+        parallel = self.download("parallel", iWorkers=4, iChunkSize=1000)
+        self.assertEqual(sequential, parallel)
+        self.assertEqual(parallel[0], (1006, ["Pg%03d_100" % pgnum for pgnum in range(1, 7)]))
+        self.assertEqual(len(parallel[1]), 6 * 2 + 2) # images, page XML, trp.json and max.ts
+
+    def test_failed_transfer_raises_and_leaves_no_partial_file(self):
+        del self.routes[("GET", "/TrpServer/files/img3")]
+        folder = os.path.join(self.work_dir, "failed")
+        with self.assertRaises(Exception):
+            self.client.download_document(1, 2, folder, iWorkers=4)
+        self.assertFalse([name for name in os.listdir(folder) if name.endswith(".part") or name == "Pg003_100.png"])
+        self.assertFalse(os.path.exists(os.path.join(folder, "max.ts")))
+
+
+# upload process of the fake server, answers every PUT with the status of all pages, fails the first PUT of the pages in fail_once
+class FakeUpload:
+    #stored_names: the file names the status reports, list_pages=False: a status without pages
+    def __init__(self, file_names, fail_once=(), stored_names=None, list_pages=True):
+        self.file_names = file_names
+        self.stored_names = stored_names or file_names
+        self.list_pages = list_pages
+        self.uploaded = set()
+        self.fail_once = set(fail_once)
+        self.lock = threading.Lock()
+
+    def status(self):
+        pages = "".join("<pages><fileName>%s</fileName><pageNr>%d</pageNr><pageUploaded>%s</pageUploaded></pages>"
+                        % (stored, pgnum + 1, str(name in self.uploaded).lower())
+                        for pgnum, (name, stored) in enumerate(zip(self.file_names, self.stored_names)) if self.list_pages)
+        job = "<jobId>77</jobId>" if self.uploaded == set(self.file_names) else ""
+        return ("<trpUpload><uploadId>55</uploadId>%s<nrOfPagesTotal>%d</nrOfPagesTotal><pageList>%s</pageList></trpUpload>"
+                % (job, len(self.file_names), pages)).encode("utf-8")
+
+    def create(self, body):
+        return 200, "application/xml", self.status()
+
+    def put(self, body):
+        name = re.search(b'name="img"; filename="([^"]+)"', body).group(1).decode("utf-8")
+        with self.lock:
+            if name in self.fail_once:
+                self.fail_once.discard(name)
+                return 500, "text/plain", b"busy"
+            self.uploaded.add(name)
+            return 200, "application/xml", self.status()
+
+
+class DocumentUpload(WorkDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.names = ["Pg%03d_100.png" % pgnum for pgnum in range(1, 7)]
+        self.parts = []
+        for name in self.names:
+            for file_name in [name, name.replace(".png", ".pxml")]:
+                with open(os.path.join(self.work_dir, file_name), "wb") as f:
+                    f.write(file_name.encode("utf-8"))
+            self.parts.append({"img": (name, Path(self.work_dir, name), "application/octet-stream"),
+                               "xml": (name.replace(".png", ".pxml"), Path(self.work_dir, name.replace(".png", ".pxml")), "application/octet-stream")})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def upload(self, upload, **kwargs):
+        self.server, url = start_fake_server({("POST", "/TrpServer/rest/uploads"): upload.create, ("PUT", "/TrpServer/rest/uploads/55"): upload.put})
+        client = TranskribusClient(sServerUrl=url)
+        client.setSessionId("abc")
+        try:
+            return client.createDocFromImages(100, "{}", self.parts, **kwargs)
+        finally:
+            client.close()
+
+    def test_parallel_upload_retries_failed_pages(self):
+        upload = FakeUpload(self.names, fail_once=["Pg002_100.png", "Pg005_100.png"])
+        status = self.upload(upload, iWorkers=4)
+        self.assertEqual(upload.uploaded, set(self.names))
+        self.assertIn("<jobId>77</jobId>", status)
+        self.assertEqual(status.count("<pageUploaded>true</pageUploaded>"), 6)
+        self.assertEqual(len([request for request in self.server.requests if request[0] == "PUT"]), 8)
+
+    def test_retried_page_is_matched_by_page_number(self):
+        upload = FakeUpload(self.names, fail_once=["Pg004_100.png"], stored_names=["page_%d.png" % pgnum for pgnum in range(1, 7)])
+        status = self.upload(upload, iWorkers=1)
+        self.assertEqual(upload.uploaded, set(self.names))
+        self.assertEqual(status.count("<pageUploaded>true</pageUploaded>"), 6)
+        self.assertEqual(len([request for request in self.server.requests if request[0] == "PUT"]), 7)
+
+    def test_status_without_pages_relies_on_the_put_status(self):
+        upload = FakeUpload(self.names, fail_once=["Pg001_100.png"], list_pages=False)
+        status = self.upload(upload, iWorkers=4)
+        self.assertEqual(upload.uploaded, set(self.names))
+        self.assertIn("<jobId>77</jobId>", status)
+        self.assertEqual(len([request for request in self.server.requests if request[0] == "PUT"]), 7)
+
+    def test_page_failing_every_retry_raises(self):
+        upload = FakeUpload(self.names, fail_once=["Pg003_100.png"])
+        with self.assertRaises(Exception):
+            self.upload(upload, iWorkers=1, iRetries=0)
+        self.assertEqual(upload.uploaded, set(self.names) - {"Pg003_100.png"})
+
+
+class StreamingMultipart(WorkDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.image = os.path.join(self.work_dir, "Pg001_100.png")
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        with open(self.image, "wb") as f:
+            f.write(self.data)
+
+    def test_body_is_read_in_bounded_chunks(self):
+        sent = []
+        stream = MultipartStream({"img": ("Pg001_100.png", Path(self.image), "image/png"), "xml": ("Pg001_100.pxml", b"<PcGts/>")}, sent.append)
+        chunks = []
+        chunk = stream.read(65536)
+        while chunk:
+            chunks.append(chunk)
+            chunk = stream.read(65536)
+        body = b"".join(chunks)
+        self.assertTrue(max(len(chunk) for chunk in chunks) <= 65536)
+        self.assertEqual((len(body), sum(sent)), (len(stream), len(stream)))
+        message = email.message_from_bytes(("Content-Type: %s\r\n\r\n" % stream.sContentType).encode("ascii") + body)
+        parts = dict((part.get_param("name", header="content-disposition"), part) for part in message.get_payload())
+        self.assertEqual(parts["img"].get_payload(decode=True), self.data)
+        self.assertEqual(parts["img"].get_content_type(), "image/png")
+        self.assertEqual(parts["xml"].get_payload(decode=True), b"<PcGts/>")
+        self.assertIsNone(stream._oFile)
+
+    def test_string_file_is_sent_as_content(self):
+        stream = MultipartStream({"xml": ("Pg001_100.pxml", self.image)})
+        body = stream.read()
+        self.assertEqual(len(body), len(stream))
+        self.assertIn(self.image.encode("utf-8"), body)
+        self.assertNotIn(self.data[:64], body)
+
+    def test_put_streams_with_content_length(self):
+        server, url = start_fake_server({("PUT", "/TrpServer/rest/uploads/55"): lambda body: (200, "application/xml", b"<ok/>")})
+        client = TranskribusClient(sServerUrl=url)
+        client.setSessionId("abc")
+        sent = []
+        try:
+            with open(self.image, "rb") as f:
+                resp = client._PUT(url + "/rest/uploads/55", pagefiles={"img": ("Pg001_100.png", f, "image/png")}, fnProgress=sent.append)
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(resp.status_code, 200)
+        body = server.requests[0][4]
+        self.assertEqual(len(body), sum(sent))
+        self.assertIn(self.data, body)
+
+
+class PageIds(WorkDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.routes = {}
+        self.server, self.url = start_fake_server(self.routes)
+        self.routes.update(fake_document(self.url, 3))
+        self.client = TranskribusClient(sServerUrl=self.url)
+        self.client.setSessionId("abc")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def paths(self):
+        return [path for method, path, port, cookie, body in self.server.requests]
+
+    def test_page_ids_from_metadata_only(self):
+        self.assertEqual(self.client.getPageIds(1, 2), {1: 101, 2: 102, 3: 103})
+        self.assertEqual(self.paths(), ["/TrpServer/rest/collections/1/2/fulldoc?nrOfTranscripts=1"])
+        self.assertEqual(self.client.getPageIds(1, 2), {1: 101, 2: 102, 3: 103})
+        self.assertEqual(len(self.paths()), 1)
+        self.client.getPageIds(1, 2, bRefresh=True)
+        self.assertEqual(len(self.paths()), 2)
+
+    def test_newer_metadata_replaces_cached_ids(self):
+        self.client.download_document(1, 2, os.path.join(self.work_dir, "doc"), bNoImage=True)
+        requests = len(self.paths())
+        self.assertEqual(self.client.getPageIds(1, 2), {1: 101, 2: 102, 3: 103})
+        self.assertEqual(len(self.paths()), requests)
+        trp = json.loads(self.routes[("GET", "/TrpServer/rest/collections/1/2/fulldoc")][2].decode("utf-8"))
+        trp["pageList"]["pages"][0]["pageId"] = 201
+        trp["pageList"]["pages"][0]["tsList"]["transcripts"][0]["timestamp"] = 2000
+        self.assertEqual(self.client.getPageIds(1, 2, trp), {1: 201, 2: 102, 3: 103})
+        self.assertEqual(self.client.getPageIds(1, 2), {1: 201, 2: 102, 3: 103})
+
+    def test_expired_ids_are_read_again_from_the_metadata(self):
+        self.client._fPageIdsTtl = 0
+        self.assertEqual(self.client.getPageIds(1, 2), {1: 101, 2: 102, 3: 103})
+        route = ("GET", "/TrpServer/rest/collections/1/2/fulldoc")
+        trp = json.loads(self.routes[route][2].decode("utf-8"))
+        trp["pageList"]["pages"][0]["pageId"] = 201 #same timestamps
+        self.routes[route] = self.routes[route][:2] + (json.dumps(trp).encode("utf-8"),)
+        self.assertEqual(self.client.getPageIds(1, 2), {1: 201, 2: 102, 3: 103})
+        self.assertEqual(len(self.paths()), 2)
+
+    def test_ids_are_cached_per_collection(self):
+        self.client.getPageIds(1, 2)
+        with self.assertRaises(Exception):
+            self.client.getPageIds(5, 2)
+        self.assertEqual(self.paths()[-1], "/TrpServer/rest/collections/5/2/fulldoc?nrOfTranscripts=1")
+
+
+if __name__ == '__main__':
+    unittest.main()
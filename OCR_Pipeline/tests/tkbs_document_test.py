@@ -0,0 +1,478 @@
+# These tests write a small legacy issue into a temporary folder, no resources are needed
+
+import unittest
+import os
+import shutil
+import zipfile
+import json
+from unittest.mock import patch
+from lxml import etree
+
+import TkbsDocument
+from TkbsDocument import Document, find_sub_folders_with_toc_file, locate_legacy, process_legacy_issues, data_size_bytes
+from tkbs_instrument import recorder
+from synthetic_issue import (write_legacy_issue, write_synthetic_issue, write_synthetic_tkbs_folder, WorkDirTestCase,
+                             TWO_PAGE_ISSUE, TINY_PNG)
+
+PAGE_NS = "{http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15}"
+
+def reading_order(pxml):
+    tree = etree.parse(pxml)
+    return [r.get("regionRef") for r in tree.iter(PAGE_NS + "RegionRefIndexed")]
+
+
+class LegacyReadingOrder(WorkDirTestCase):
+    def convert(self, pages, name, workers=1):
+        src = os.path.join(self.work_dir, name)
+        out = os.path.join(self.work_dir, name + "_output")
+        write_legacy_issue(src, pages)
+        p = Document()
+        p.load_legacy_data(src, workers=workers)
+        p.export_tkbs_format(out)
+        return out
+
+    def test_reading_order_on_multi_page_issue(self):
+        out = self.convert(TWO_PAGE_ISSUE, "issue")
+        self.assertEqual(reading_order(os.path.join(out, "Pg001_100.pxml")),
+                         ["Ar0010103", "Ar0010101", "Ar0010102", "Ar0010202", "Ar0010201", "Ar0010203"])
+        self.assertEqual(reading_order(os.path.join(out, "Pg002_100.pxml")),
+                         ["Ar0020103", "Ar0020102", "Ar0020101", "Ad0020202"])
+
+    def test_later_pages_do_not_reindex_earlier_headlines(self):
+        single = self.convert({1: TWO_PAGE_ISSUE[1]}, "single")
+        double = self.convert(TWO_PAGE_ISSUE, "double")
+        self.assertEqual(reading_order(os.path.join(single, "Pg001_100.pxml")),
+                         reading_order(os.path.join(double, "Pg001_100.pxml")))
+
+    def test_worker_pool_matches_sequential_parse(self):
+        sequential = self.convert(TWO_PAGE_ISSUE, "sequential")
+        parallel = self.convert(TWO_PAGE_ISSUE, "parallel", workers=4)
+        for name in sorted(os.listdir(sequential)):
+            with open(os.path.join(sequential, name), "rb") as s, open(os.path.join(parallel, name), "rb") as p:
+                self.assertEqual(s.read(), p.read())
+
+
+class LegacyMetaLoad(WorkDirTestCase):
+    def test_meta_load_matches_full_load(self):
+        write_legacy_issue(self.work_dir, TWO_PAGE_ISSUE)
+        full = Document()
+        full.load_legacy_data(self.work_dir)
+        meta = Document()
+        meta.load_legacy_meta(self.work_dir, headers=True)
+        self.assertEqual(meta.doc_title, full.doc_title)
+        self.assertEqual(meta.img_names_by_pgnum(), full.img_names_by_pgnum())
+        self.assertEqual(meta.pxml_names_by_pgnum(), full.pxml_names_by_pgnum())
+        self.assertEqual(meta.EntitiesIndex, full.EntitiesIndex)
+        self.assertEqual(meta.article_types, full.article_types)
+        self.assertEqual(meta.HeaderPrimitives, full.HeaderPrimitives)
+        self.assertEqual(sorted(meta.legacy_articles), sorted(full.legacy_articles))
+        self.assertEqual(meta.RegionBoxing, {})
+
+
+class LegacyLines(WorkDirTestCase):
+    def test_lines_match_the_single_box_conversion(self):
+        write_legacy_issue(self.work_dir, TWO_PAGE_ISSUE, lines=2)
+        p = Document()
+        p.load_legacy_data(self.work_dir, workers=2)
+        self.assertEqual(p.LineIndexInRegion["Ar0010101_2"], 2)
+        self.assertEqual(len(p.LineBoxing), 2 * (len(p.ContentPrimitives) - 1)) #the picture has no lines
+        self.assertEqual(p.LineBoxing["Ar0010101_2"], p.legacy_box_points("10 30 900 48", p.PagesResolutionFactor["1"], p.cut_low_line_part))
+
+    def test_garbage_lines_are_skipped(self):
+        write_legacy_issue(self.work_dir, TWO_PAGE_ISSUE)
+        p = Document()
+        p.set_garbage_line_width(1000)
+        p.load_legacy_data(self.work_dir)
+        self.assertEqual((p.LineBoxing, p.LineIndexInRegion), ({}, {}))
+
+
+class LegacySnapshot(WorkDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.src = os.path.join(self.work_dir, "issue")
+        self.cache = os.path.join(self.work_dir, "snapshots")
+        write_legacy_issue(self.src, TWO_PAGE_ISSUE)
+
+    def test_snapshot_restores_parsed_state(self):
+        full = Document()
+        full.load_legacy_data(self.src, cachedir=self.cache)
+        cached = Document()
+        self.assertTrue(cached.load_legacy_snapshot(self.src, self.cache, "data"))
+        for field in full.snapshot_fields:
+            self.assertEqual(getattr(cached, field).__class__, getattr(full, field).__class__, field)
+        self.assertEqual(cached.RegionBoxing, full.RegionBoxing)
+        self.assertEqual(cached.PrimitivesIndexInPage, full.PrimitivesIndexInPage)
+        self.assertEqual(sorted(cached.legacy_articles), sorted(full.legacy_articles))
+        meta = Document()
+        meta.load_legacy_meta(self.src, cachedir=self.cache)
+        self.assertEqual(meta.RegionBoxing, full.RegionBoxing)
+
+    def test_changed_source_invalidates_snapshot(self):
+        Document().load_legacy_data(self.src, cachedir=self.cache)
+        arfile = os.path.join(self.src, "Document", "1", "Ar00101.xml")
+        with open(arfile) as f:
+            arxml = f.read()
+        with open(arfile, "w") as f:
+            f.write(arxml.replace('BOX="10 10 900 50"', 'BOX="20 10 900 50"'))
+        stat = os.stat(arfile)
+        os.utime(arfile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        p = Document()
+        self.assertFalse(p.load_legacy_snapshot(self.src, self.cache, "data"))
+        p.load_legacy_data(self.src, cachedir=self.cache)
+        self.assertTrue(p.RegionBoxing["Ar0010101"].startswith("900,"))
+        self.assertTrue(p.RegionBoxing["Ar0010101"].endswith(" 20,10 900,10"))
+        self.assertTrue(Document().load_legacy_snapshot(self.src, self.cache, "data"))
+
+    def test_snapshot_checks_image_names_not_image_files(self):
+        Document().load_legacy_data(self.src, cachedir=self.cache)
+        image = os.path.join(self.src, "Document", "1", "Img", "Pg001_100.png")
+        with open(image, "wb") as f:
+            f.write(b"a new scan")
+        self.assertTrue(Document().load_legacy_snapshot(self.src, self.cache, "data"))
+        with open(os.path.join(self.src, "Document", "1", "Img", "Pg001_200.png"), "wb") as f:
+            f.write(b"png")
+        self.assertFalse(Document().load_legacy_snapshot(self.src, self.cache, "data"))
+
+    def test_no_snapshot_after_a_failed_parse(self):
+        with open(os.path.join(self.src, "Document", "2", "Ar00201.xml"), "w") as f:
+            f.write("<Xmd_article")
+        p = Document()
+        p.load_legacy_data(self.src, cachedir=self.cache)
+        self.assertEqual(len(p.errors), 1)
+        self.assertFalse(Document().load_legacy_snapshot(self.src, self.cache, "data"))
+        with open(os.path.join(self.src, "Document", "2", "Pg002.xml"), "w") as f:
+            f.write("<Xmd_page")
+        p = Document()
+        p.load_legacy_meta(self.src, headers=True, cachedir=self.cache)
+        self.assertNotEqual(p.errors, [])
+        self.assertFalse(Document().load_legacy_snapshot(self.src, self.cache, "headers"))
+
+    def test_snapshot_paths_are_absolute(self):
+        cwd = os.getcwd()
+        os.chdir(self.work_dir)
+        try:
+            src = os.path.abspath("issue")
+            Document().load_legacy_data("issue", cachedir=self.cache)
+        finally:
+            os.chdir(cwd)
+        p = Document()
+        self.assertTrue(p.load_legacy_snapshot(src, self.cache, "data"))
+        self.assertEqual(p.legacydir, src)
+        self.assertTrue(all(os.path.isfile(name) for name in p.PagesImgName.values()))
+
+
+class ImageStaging(WorkDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.src = os.path.join(self.work_dir, "issue")
+        write_legacy_issue(self.src, TWO_PAGE_ISSUE)
+
+    def stage(self, staging, name):
+        p = Document()
+        p.image_staging = staging
+        p.load_legacy_data(self.src)
+        out = os.path.join(self.work_dir, name)
+        p.export_tkbs_format(out)
+        return p, os.path.join(out, "Pg001_100.png")
+
+    def test_hardlink_and_symlink_share_the_source(self):
+        image = os.path.join(self.src, "Document", "1", "Img", "Pg001_100.png")
+        p, target = self.stage("hardlink", "hardlink")
+        self.assertEqual(p.PagesImgStaging["1"], "hardlink")
+        self.assertTrue(os.path.samefile(image, target))
+        p, target = self.stage("symlink", "symlink")
+        self.assertEqual(p.PagesImgStaging["1"], "symlink")
+        self.assertTrue(os.path.islink(target))
+
+    def test_reflink_falls_back_to_copy(self):
+        p, target = self.stage("reflink", "reflink")
+        self.assertIn(p.PagesImgStaging["1"], ["reflink", "copy"])
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), TINY_PNG)
+
+    def test_replaced_source_is_staged_again(self):
+        image = os.path.join(self.src, "Document", "1", "Img", "Pg001_100.png")
+        p, target = self.stage("hardlink", "restage")
+        with open(image + ".new", "wb") as f:
+            f.write(b"new png")
+        os.replace(image + ".new", image)
+        p, target = self.stage("copy", "restage")
+        self.assertEqual(p.PagesImgStaging, {"1": "copy"})
+        self.assertFalse(os.path.samefile(image, target))
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), b"new png")
+
+    def test_failed_image_keeps_the_other_pages(self):
+        stage = TkbsDocument.legacy_source.stage
+        def failing_stage(source, file_name, target_file, strategies):
+            if file_name.endswith("Pg001_100.png"):
+                raise OSError("disk full")
+            return stage(source, file_name, target_file, strategies)
+        p = Document()
+        p.image_staging = "hardlink"
+        p.load_legacy_data(self.src)
+        out = os.path.join(self.work_dir, "partial")
+        os.makedirs(out)
+        with patch.object(TkbsDocument.legacy_source, "stage", failing_stage):
+            self.assertEqual(p.copy_transkribus_images(out), 1)
+        self.assertEqual(p.PagesImgStaging, {"2": "hardlink"})
+        self.assertEqual(os.listdir(out), ["Pg002_100.png"])
+        self.assertEqual(len(p.errors), 1)
+
+
+class IssueDiscovery(WorkDirTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ["1914/11-06", "1914/11-07", "1920/01-06"]:
+            write_legacy_issue(os.path.join(self.work_dir, name), {1: TWO_PAGE_ISSUE[1]})
+        os.makedirs(os.path.join(self.work_dir, "legacy_output", "1914", "11-06"))
+        os.makedirs(os.path.join(self.work_dir, "legacy_snapshots"))
+        self.index = os.path.join(self.work_dir, "legacy_snapshots", "issue_index.json")
+
+    def walk(self):
+        return [subdir for subdir, dirs, files in os.walk(self.work_dir) if "TOC.xml" in files]
+
+    def age_folders(self):
+        for subdir, dirs, files in os.walk(self.work_dir):
+            os.utime(subdir, (0, 0))
+
+    def test_pruned_scan_matches_full_walk(self):
+        self.assertEqual(find_sub_folders_with_toc_file(self.work_dir), self.walk())
+
+    def test_index_lists_only_changed_folders(self):
+        self.age_folders()
+        self.assertEqual(find_sub_folders_with_toc_file(self.work_dir, self.index), self.walk())
+        with patch.object(TkbsDocument, "list_issue_folder", wraps=TkbsDocument.list_issue_folder) as listed:
+            self.assertEqual(find_sub_folders_with_toc_file(self.work_dir, self.index), self.walk())
+            self.assertEqual(listed.call_count, 0)
+            write_legacy_issue(os.path.join(self.work_dir, "1914", "11-08"), {1: TWO_PAGE_ISSUE[1]})
+            found = find_sub_folders_with_toc_file(self.work_dir, self.index)
+        self.assertEqual(found, self.walk())
+        self.assertIn(os.path.join(self.work_dir, "1914", "11-08"), found)
+        self.assertEqual([call[0][0] for call in listed.call_args_list],
+                         [os.path.join(self.work_dir, "1914"), os.path.join(self.work_dir, "1914", "11-08")])
+
+
+class LocateLegacy(WorkDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tocs = {}
+        for day in ["06", "07", "08"]:
+            release_no = "021-HZF-1914-11-" + day + "-001-4007" + day
+            folder = os.path.join(self.work_dir, "1914", "11-" + day)
+            write_legacy_issue(folder, {1: TWO_PAGE_ISSUE[1]}, release_no=release_no)
+            self.tocs[day] = os.path.join(folder, "TOC.xml")
+        self.index = os.path.join(self.work_dir, "legacy_snapshots", "legacy_index.sqlite")
+
+    def test_index_answers_like_the_scan(self):
+        for doc in ["021-HZF-1914-11-07-001-400707", "HZF-1914-11-07", "title 2"]:
+            self.assertEqual(locate_legacy(doc, self.work_dir, self.index), locate_legacy(doc, self.work_dir))
+        self.assertEqual(locate_legacy("HZF-1914-11-08", self.work_dir, self.index), self.tocs["08"])
+
+    def test_index_is_updated_incrementally(self):
+        self.assertEqual(locate_legacy("HZF-1914-11-06", self.work_dir, self.index), self.tocs["06"])
+        write_legacy_issue(os.path.join(self.work_dir, "1914", "11-09"), {1: TWO_PAGE_ISSUE[1]},
+                           release_no="021-HZF-1914-11-09-001-400709")
+        with patch.object(TkbsDocument, "legacy_toc_keys", wraps=TkbsDocument.legacy_toc_keys) as read:
+            self.assertEqual(locate_legacy("HZF-1914-11-09", self.work_dir, self.index),
+                             os.path.join(self.work_dir, "1914", "11-09", "TOC.xml"))
+            self.assertEqual(locate_legacy("HZF-1914-11-07", self.work_dir, self.index), self.tocs["07"])
+        self.assertEqual([call[0][0] for call in read.call_args_list], [os.path.join(self.work_dir, "1914", "11-09", "TOC.xml")])
+
+    def test_toc_files_are_named_like_the_scan(self):
+        folder = os.path.join(self.work_dir, "1914", "11-10")
+        write_legacy_issue(folder, {1: TWO_PAGE_ISSUE[1]}, release_no="021-HZF-1914-11-10-001-400710")
+        os.rename(os.path.join(folder, "TOC.xml"), os.path.join(folder, "1914-11-10_toc.xml"))
+        self.assertEqual(locate_legacy("HZF-1914-11-10", self.work_dir, self.index), os.path.join(folder, "1914-11-10_toc.xml"))
+        self.assertEqual(locate_legacy("400710", self.work_dir, self.index), locate_legacy("400710", self.work_dir))
+
+    def test_missing_string_is_searched_again_only_in_changed_files(self):
+        self.assertIsNone(locate_legacy("not in any issue", self.work_dir, self.index))
+        with patch.object(TkbsDocument.mmap, "mmap", wraps=TkbsDocument.mmap.mmap) as searched:
+            self.assertIsNone(locate_legacy("not in any issue", self.work_dir, self.index))
+            self.assertEqual(searched.call_count, 0)
+            with open(self.tocs["07"], "a") as f:
+                f.write("<!-- not in any issue -->")
+            self.assertEqual(locate_legacy("not in any issue", self.work_dir, self.index), self.tocs["07"])
+            self.assertEqual(searched.call_count, 1)
+
+
+class BoundedMemory(WorkDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.src = os.path.join(self.work_dir, "issue")
+        write_legacy_issue(self.src, TWO_PAGE_ISSUE)
+
+    def test_released_pages_write_the_same_output(self):
+        outputs = []
+        for release_pages in [False, True]:
+            p = Document()
+            p.load_legacy_data(self.src)
+            out = os.path.join(self.work_dir, "out" + str(release_pages))
+            p.export_tkbs_format(out, release_pages=release_pages)
+            outputs.append(out)
+        self.assertEqual(p.RegionBoxing, {})
+        self.assertEqual(p.PagesPlan, {})
+        for name in sorted(os.listdir(outputs[0])):
+            with open(os.path.join(outputs[0], name), "rb") as kept, open(os.path.join(outputs[1], name), "rb") as released:
+                self.assertEqual(kept.read(), released.read())
+
+    def test_batch_releases_every_document(self):
+        documents = []
+        def load(p, folder):
+            documents.append(p)
+            if folder != self.src:
+                raise ValueError("not an issue")
+            p.load_legacy_data(folder)
+            return p.page_count
+        results = process_legacy_issues([self.src, self.work_dir], load, memory_budget_mb=4096)
+        self.assertEqual([(folder, result) for folder, result, peak in results], [(self.src, 2), (self.work_dir, None)])
+        self.assertTrue(all(peak is None or peak > 0 for folder, result, peak in results))
+        for p in documents:
+            self.assertIsNone(p.legacy_source)
+            self.assertEqual((p.page_count, p.RegionBoxing, p.legacy_articles), (0, {}, {}))
+
+    @unittest.skipIf(data_size_bytes() is None, "no VmData to budget against")
+    def test_issue_over_the_budget_fails_and_the_batch_goes_on(self):
+        second = os.path.join(self.work_dir, "second")
+        write_legacy_issue(second, TWO_PAGE_ISSUE)
+        def load(p, folder):
+            if folder == self.src:
+                read_legacy_meta = p.read_legacy_meta
+                def read_and_grow(inputdir):
+                    read_legacy_meta(inputdir)
+                    p.grown = bytearray(64 * 1024 * 1024)
+                p.read_legacy_meta = read_and_grow
+            p.load_legacy_data(folder)
+            return p.page_count
+        results = process_legacy_issues([self.src, second], load, memory_budget_mb=16)
+        self.assertEqual([(folder, result) for folder, result, peak in results], [(self.src, None), (second, 2)])
+
+    def test_article_classes_have_no_instance_dict(self):
+        p = Document()
+        p.load_legacy_data(self.src)
+        article = list(p.legacy_articles.values())[0]
+        self.assertFalse(hasattr(article, "__dict__"))
+        self.assertFalse(hasattr(list(article.entities.values())[0], "__dict__"))
+
+
+class StageTimings(WorkDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.src = os.path.join(self.work_dir, "issue")
+        write_legacy_issue(self.src, TWO_PAGE_ISSUE)
+        self.logfile = os.path.join(self.work_dir, "timings", "stage_timings.jsonl")
+        recorder.open(self.logfile)
+
+    def tearDown(self):
+        recorder.open(None)
+        super().tearDown()
+
+    def test_one_record_per_issue_with_nested_stages(self):
+        def convert(p, folder):
+            p.load_legacy_data(folder)
+            with recorder.stage("export") as record:
+                p.export_tkbs_format(os.path.join(self.work_dir, "out"))
+                record["items"] = len(p.pxmlOutname)
+        process_legacy_issues([self.src, self.src], convert)
+        with open(self.logfile) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record["issue"] for record in records], [self.src, self.src])
+        stages = dict((stage["stage"], stage) for stage in records[0]["stages"])
+        self.assertEqual(sorted(stages), ["export", "export/export_tkbs_format", "export/export_tkbs_format/copy_transkribus_images", "load_legacy_data"])
+        self.assertEqual((stages["load_legacy_data"]["items"], stages["export"]["items"]), (2, 2))
+        self.assertTrue(stages["export/export_tkbs_format"]["write_bytes"] >= 0)
+        self.assertTrue(records[0]["wall_s"] >= stages["load_legacy_data"]["wall_s"] >= 0)
+
+    def test_image_count_is_per_call(self):
+        def export_twice(p, folder):
+            p.load_legacy_data(folder)
+            p.export_tkbs_format(os.path.join(self.work_dir, "out"))
+            p.export_tkbs_format(os.path.join(self.work_dir, "out"))
+        process_legacy_issues([self.src], export_twice)
+        with open(self.logfile) as f:
+            stages = json.loads(f.readline())["stages"]
+        self.assertEqual([stage["items"] for stage in stages if stage["stage"].endswith("copy_transkribus_images")], [2, 0])
+
+    def test_nothing_is_recorded_outside_an_issue(self):
+        p = Document()
+        p.load_legacy_data(self.src)
+        with recorder.stage("alone") as record:
+            pass
+        self.assertEqual(record, {})
+        self.assertFalse(os.path.exists(self.logfile))
+
+
+class SyntheticIssue(WorkDirTestCase):
+    def test_all_stages_on_synthetic_issue(self):
+        src = write_synthetic_issue(os.path.join(self.work_dir, "issue"), pages=3, entities=5, primitives=4, lines=2)
+        converted = os.path.join(self.work_dir, "converted")
+        p = Document()
+        p.load_legacy_data(src)
+        p.export_tkbs_format(converted)
+        self.assertEqual(sorted(os.listdir(converted)), ["Pg00%d_100.%s" % (n, ext) for n in [1, 2, 3] for ext in ["png", "pxml"]])
+        p.load_tkbs_data(write_synthetic_tkbs_folder(p, converted, os.path.join(self.work_dir, "tkbs"), lines=2))
+        p.match_legacy_articles()
+        self.assertEqual(len(p.articles), 15)
+        self.assertEqual(p.articles["1"].header, "line 1 of Ar0010101\nline 2 of Ar0010101")
+        p.export_tei(self.work_dir)
+        tei = etree.parse(os.path.join(self.work_dir, p.title + "_tei.xml"))
+        self.assertEqual(len(tei.findall("{http://www.tei-c.org/ns/1.0}text/{http://www.tei-c.org/ns/1.0}body/{http://www.tei-c.org/ns/1.0}div")), 15)
+
+
+class ImageVariants(WorkDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.src = os.path.join(self.work_dir, "issue")
+        write_legacy_issue(self.src, TWO_PAGE_ISSUE)
+        toc = os.path.join(self.src, "TOC.xml")
+        with open(toc) as f:
+            text = f.read()
+        with open(toc, "w") as f:
+            f.write(text.replace("<Resolution>100</Resolution>", "<Resolution>200</Resolution>"))
+        for pgnum, resolution in [(1, 200), (2, 50)]:
+            img = os.path.join(self.src, "Document", str(pgnum), "Img", "Pg%03d_" % pgnum)
+            os.rename(img + "100.png", img + str(resolution) + ".png")
+
+    def test_variant_is_chosen_from_one_listing_per_page(self):
+        p = Document()
+        with patch("TkbsDocument.os.listdir", wraps=os.listdir) as listdir, \
+                patch("TkbsDocument.os.path.exists", wraps=os.path.exists) as exists:
+            p.load_legacy_data(self.src)
+        self.assertEqual(listdir.call_count, 2)
+        self.assertFalse([call for call in exists.call_args_list if str(call[0][0]).endswith(".png")])
+        self.assertEqual(p.PagesImgVariant, {"1": "200", "2": "50"})
+        self.assertEqual(p.PagesResolutionFactor, {"1": 2.0, "2": 0.5})
+        self.assertEqual(sorted(p.pxmlOutname.values()), ["Pg001_200.pxml", "Pg002_50.pxml"])
+        self.assertTrue(all(os.path.isfile(name) for name in p.PagesImgName.values()))
+
+
+class LegacyZipSource(WorkDirTestCase):
+    def test_zipped_document_matches_extracted_folder(self):
+        folder = os.path.join(self.work_dir, "folder")
+        zipped = os.path.join(self.work_dir, "zipped")
+        write_legacy_issue(folder, TWO_PAGE_ISSUE)
+        write_legacy_issue(zipped, TWO_PAGE_ISSUE)
+        docdir = os.path.join(zipped, "Document")
+        with zipfile.ZipFile(docdir + ".zip", "w") as z:
+            for root, dirs, files in os.walk(docdir):
+                for name in files:
+                    full = os.path.join(root, name)
+                    z.write(full, os.path.relpath(full, docdir).replace(os.sep, "/"))
+        shutil.rmtree(docdir)
+        outputs = []
+        for src in [folder, zipped]:
+            p = Document()
+            p.load_legacy_data(src)
+            p.export_tkbs_format(src + "_output")
+            p.legacy_source.close()
+            outputs.append(sorted(os.listdir(src + "_output")))
+        self.assertFalse(os.path.isdir(docdir))
+        self.assertEqual(outputs[0], outputs[1])
+        for name in outputs[0]:
+            with open(os.path.join(folder + "_output", name), "rb") as f, open(os.path.join(zipped + "_output", name), "rb") as z:
+                self.assertEqual(f.read(), z.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
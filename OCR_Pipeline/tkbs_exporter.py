@@ -1,12 +1,13 @@
 import json
 import os
-import xml.etree.cElementTree as ET
 import datetime
 import glob
-from TkbsDocument import Document
+from TkbsDocument import legacy_toc, find_sub_folders_with_toc_file, process_legacy_issues
+from tkbs_instrument import recorder
 
 class Config:
     def __init__(self, config_parameters=None):
+        self.memory_budget_mb = None # optional cap of the process data size while an issue is exported
         if os.path.isfile('conf.json'):
             with open('conf.json') as json_file:
                 conf_json = json.load(json_file)
@@ -14,6 +15,7 @@ class Config:
             self.export_tei = conf_json["export_tei"]
             self.export_plaintext = conf_json["export_plaintext"]
             self.export_csv = conf_json["export_csv"]
+            self.memory_budget_mb = conf_json.get("memory_budget_mb")
         elif config_parameters is None:
             self.src_path = set_source_path()
             self.export_tei = set_export("TEI")
@@ -79,26 +81,8 @@ def create_json_for_request(document_id, page_ids):
     return json_string
 
 
-def find_sub_folders_with_toc_file(dir_path):  # Get absolute path
-    sub_folders_with_TOC_file = []
-    for subdir, dirs, files in os.walk(dir_path):
-        for file in files:
-            if file == "TOC.xml":
-                sub_folders_with_TOC_file.append(subdir)
-    return sub_folders_with_TOC_file
-
-
 def extract_title_from_TOC_xml(TOC_path):
-    tree = ET.parse(TOC_path)
-    root = tree.getroot()
-    source = {}
-    for s in root.iter('Link'):
-        source = s.attrib
-    if source == {}:
-        title = "unknown title"
-    else:
-        title = (source["SOURCE"])[:-4]
-    return title
+    return legacy_toc(TOC_path).title
 
 
 #check if dir exists, creates it if not
@@ -125,9 +109,10 @@ def find_latest_folder(topfolder, start_pattern):
 
 v = False
 def export_pipeline(config):
-    folders_to_be_exported = find_sub_folders_with_toc_file(config.src_path)
+    folders_to_be_exported = find_sub_folders_with_toc_file(config.src_path, os.path.join(config.src_path, "legacy_snapshots", "issue_index.json"))
     tkbs_topfolder = os.path.join(config.src_path, "transkribus_output")
     exportfolder = prep_dir(os.path.join(config.src_path, "transkribus_export"))
+    recorder.open(os.path.join(exportfolder, "stage_timings.jsonl"))
     if config.export_csv:
         csvfolder_byregion = prep_dir(os.path.join(exportfolder, 'csv_by_region'))
         csvfolder_byarticle = prep_dir(os.path.join(exportfolder, 'csv_by_article'))
@@ -136,20 +121,22 @@ def export_pipeline(config):
         plaintextfolder_byarticle = prep_dir(os.path.join(exportfolder, 'plaintext_by_article'))
     if config.export_tei:
         teifolder = prep_dir(os.path.join(exportfolder, 'tei'))
-    for sfolder in folders_to_be_exported:
+    # one issue at a time, its Document is released before the next one
+    def export_a_folder(p, sfolder):
         try:
             if not os.path.isfile(os.path.join(sfolder, 'TOC.xml')):
-                continue
+                return
             infolder = sfolder
             
             start = str(datetime.datetime.now().strftime("%y-%m-%d-%H-%M"))
             print(start + " - " + infolder)# + "\n==============")
             v and print("---   LOADING Legacy data ---")
-            p = Document()
-            p.load_legacy_data(infolder)
-            tkbsfolder = find_latest_folder(tkbs_topfolder, p.doc_title)
+            p.load_legacy_meta(infolder, headers=True, cachedir=os.path.join(config.src_path, "legacy_snapshots"))
+            with recorder.stage("find_latest_folder"):
+                tkbsfolder = find_latest_folder(tkbs_topfolder, p.doc_title)
             p.load_tkbs_data(tkbsfolder) #FIX
-            p.load_legacy_articles(p.legacy_metafile)
+            with recorder.stage("load_legacy_articles"):
+                p.load_legacy_articles(p.legacy_metafile)
             p.match_legacy_articles()
 
             if config.export_tei:
@@ -158,21 +145,26 @@ def export_pipeline(config):
     
             if config.export_plaintext:
                 v and print("---   PLAINTEXT export     ---")
-                p.export_plaintext(plaintextfolder)
-                p.export_plaintext_articles(plaintextfolder_byarticle)
+                with recorder.stage("plaintext"):
+                    p.export_plaintext(plaintextfolder)
+                    p.export_plaintext_articles(plaintextfolder_byarticle)
             
             if config.export_csv:
                 v and print("---   CSV export           ---")
-                p.export_csv_articles(csvfolder_byarticle)
-                p.export_csv_regions(csvfolder_byregion)
+                with recorder.stage("csv"):
+                    p.export_csv_articles(csvfolder_byarticle)
+                    p.export_csv_regions(csvfolder_byregion)
     
             
+        except MemoryError:
+            raise #over the memory budget, reported by process_legacy_issues
         except Exception as e:
             print("ERROR in export_pipeline main loop ")
             print (e)
             print ("END ERROR \n\n")
             pass
 
+    process_legacy_issues(folders_to_be_exported, export_a_folder, config.memory_budget_mb)
 
     print("DONE. Output is under " + exportfolder)
 
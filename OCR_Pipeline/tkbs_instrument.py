@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+
+OMILAB 2019
+Stage timings of the pipeline: wall time, CPU time, bytes read and written and item counts of every stage,
+written as one JSON line per issue.
+
+"""
+
+import os, json, time, threading, functools
+from contextlib import contextmanager
+
+
+#bytes read and written by the process so far (Linux), zeros where it is not available
+#the counters are per process, stages of issues processed at the same time in threads share them
+def io_counters():
+    try:
+        counters = {}
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                counters[key] = int(value)
+        return counters["rchar"], counters["wchar"]
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+class stage_recorder:
+
+    #records nothing until open is called, every thread records its own issue
+    def __init__(self):
+        self.logfile = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    #append the issue records to logfile, None stops recording
+    def open(self, logfile):
+        if logfile is not None and os.path.dirname(logfile) and not os.path.isdir(os.path.dirname(logfile)):
+            os.makedirs(os.path.dirname(logfile))
+        self.logfile = logfile
+
+    def start_issue(self, issue):
+        if self.logfile is None:
+            return
+        self.local.stack = []
+        self.local.issue = {"issue": issue, "started": time.strftime("%Y-%m-%dT%H:%M:%S"), "stages": []}
+        self.local.issue_start = self.counters()
+
+    #write the issue record with its stages and totals, extra fields are added to the record
+    def end_issue(self, **extra):
+        issue = getattr(self.local, "issue", None)
+        if issue is None:
+            return
+        self.local.issue = None
+        issue.update(self.measure(self.local.issue_start))
+        issue.update(extra)
+        with self.lock:
+            if self.logfile is not None:
+                with open(self.logfile, "a") as f:
+                    f.write(json.dumps(issue) + "\n")
+
+    @contextmanager
+    def issue(self, issue):
+        self.start_issue(issue)
+        try:
+            yield
+        finally:
+            self.end_issue()
+
+    #time the block as a stage of the current issue, the yielded record takes extra fields such as items
+    #nested stages are named parent/child
+    @contextmanager
+    def stage(self, name, items=None):
+        issue = getattr(self.local, "issue", None)
+        if issue is None:
+            yield {}
+            return
+        self.local.stack.append(name)
+        record = {"stage": "/".join(self.local.stack), "items": items}
+        start = self.counters()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            self.local.stack.pop()
+            record.update(self.measure(start))
+            issue["stages"].append(record)
+
+    def counters(self):
+        rchar, wchar = io_counters()
+        return time.perf_counter(), time.process_time(), rchar, wchar
+
+    def measure(self, start):
+        wall, cpu, rchar, wchar = self.counters()
+        return {"wall_s": round(wall - start[0], 6), "cpu_s": round(cpu - start[1], 6),
+                "read_bytes": rchar - start[2], "write_bytes": wchar - start[3]}
+
+
+recorder = stage_recorder()
+
+
+#record a method as a stage of the current issue, items(self, result) gives its item count
+def timed_stage(name, items=None):
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with recorder.stage(name) as record:
+                result = method(self, *args, **kwargs)
+                if items is not None and "stage" in record:
+                    record["items"] = items(self, result)
+                return result
+        return wrapper
+    return decorate
@@ -2,6 +2,7 @@ import json
 import os
 import shutil
 import time
+from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor
 import xml.etree.cElementTree as ET
 import datetime
@@ -9,11 +10,13 @@ from xml.etree import ElementTree
 from urllib3 import disable_warnings
 from urllib3.exceptions import InsecureRequestWarning
 from TkbsApiClient import TranskribusClient
-from TkbsDocument import Document
+from TkbsDocument import Document, legacy_toc, find_sub_folders_with_toc_file, process_legacy_issues
+from tkbs_instrument import recorder
 
 class Config:
     def __init__(self, config_parameters=None):
         self.default_garbage_line_width = 13
+        self.memory_budget_mb = None # optional cap of the process data size while an issue is processed
         if os.path.isfile('conf.json'):
             with open('conf.json') as json_file:
                 conf_json = json.load(json_file)
@@ -25,6 +28,7 @@ class Config:
             self.htr_model_id = conf_json["htr_model_id"]
             self.htr_lang_model = conf_json["htr_language_model"]
             self.user_garbage_line_width = conf_json["garbage_line_width"]
+            self.memory_budget_mb = conf_json.get("memory_budget_mb")
             
         elif config_parameters is None:
             self.username = set_username()
@@ -126,19 +130,9 @@ def extract_json_for_tkbs_from_toc_file(toc_folder_path="resources_for_tests\\19
                                         images_and_xmls_folder_path="resources_for_tests\\output\\1914-11-06",
                                         author="test_user", description="pipeline"):
     p = Document()
-    p.load_legacy_data(os.path.join(toc_folder_path))
+    p.load_legacy_meta(os.path.join(toc_folder_path))
     page_images, page_xmls = p.img_names_by_pgnum(), p.pxml_names_by_pgnum()
-    title = extract_title_from_TOC_xml(os.path.join(toc_folder_path, "TOC.xml"))
-    img_objects = {}
-
-    for key, value in page_images.items():
-        with open(os.path.join(images_and_xmls_folder_path, value), 'rb') as file:
-            img_objects[key] = file.read()
-
-    xml_objects = {}
-    for key, value in page_xmls.items():
-        with open(os.path.join(images_and_xmls_folder_path, value), 'rb') as file:
-            xml_objects[key] = file.read()
+    title = p.load_legacy_toc(os.path.join(toc_folder_path, "TOC.xml")).title
 
     d = {"md": {"title": title, "author": author, "description": description},
          "pageList": {"pages": [{"fileName": value, "pageXmlName": page_xmls[
@@ -146,30 +140,25 @@ def extract_json_for_tkbs_from_toc_file(toc_folder_path="resources_for_tests\\19
 
     json_as_str = json.dumps(d)
 
-    img_and_xml_list = [{'img': (value, img_objects[key], 'application/octet-stream'),
-                         'xml': (page_xmls[key], xml_objects[key], 'application/octet-stream')} for key, value in
-                        page_images.items()]
+    # file paths, the client streams each file from disk while its page is sent
+    img_and_xml_list = [{'img': (value, Path(images_and_xmls_folder_path, value), 'application/octet-stream'),
+                         'xml': (page_xmls[key], Path(images_and_xmls_folder_path, page_xmls[key]), 'application/octet-stream')}
+                        for key, value in page_images.items()]
     return json_as_str, img_and_xml_list
 
 
 def upload(collection, input_folder, pageImages, pageXmls, title, author, description, mytkbs):
     try:
-        ImgObjects = {}
-        for key, value in pageImages.items():
-            ImgObjects[key] = open(os.path.join(input_folder, value), 'rb')
-        XmlObjects = {}
-        for key, value in pageXmls.items():
-            XmlObjects[key] = open(os.path.join(input_folder, value), 'rb')
-        pfiles = []
+        pfiles = [] #file paths, each file is opened by the client only while its page is sent
         jstring = '{"md": {"title": "' + title + '", "author": "' + author + '", "description": "' + description + '"}, "pageList": {"pages": ['
         psik = ', '
         for key, value in pageImages.items():
             if len(pageImages) <= int(key):
                 psik = ''
             jstring = jstring + '{"fileName": "' + value + '", "pageXmlName": "' + pageXmls[key] + '", "pageNr": ' + key + '}' + psik
-            pfiles.append({'img': (value, ImgObjects[key], 'application/octet-stream'), 'xml': (pageXmls[key], XmlObjects[key], 'application/octet-stream')})
+            pfiles.append({'img': (value, Path(input_folder, value), 'application/octet-stream'), 'xml': (pageXmls[key], Path(input_folder, pageXmls[key]), 'application/octet-stream')})
         jstring = jstring + ']}}'
-        response = mytkbs.createDocFromImages(collection, jstring, pfiles)
+        response = mytkbs.createDocFromImages(collection, jstring, pfiles, iWorkers=4)
         tree = ElementTree.fromstring(response)
         total = tree.find('nrOfPagesTotal').text
         docid = tree.find('uploadId').text
@@ -246,7 +235,7 @@ def get_doc(collection, mydocid, mytkbs):
 
 def download(collection, documentid, folder, mytkbs, metafilename):
     try:
-        response = mytkbs.download_document(collection, documentid, folder)
+        response = mytkbs.download_document(collection, documentid, folder, iWorkers=4)
         pages = len(response[1])
         if pages > 0:
             with open(os.path.join(folder, metafilename)) as j:  
@@ -281,42 +270,20 @@ def create_json_for_request(document_id, page_ids):
     return json_string
 
 
-def find_sub_folders_with_toc_file(dir_path):  # Get absolute path
-    sub_folders_with_TOC_file = []
-    for subdir, dirs, files in os.walk(dir_path):
-        for file in files:
-            if file == "TOC.xml":
-                sub_folders_with_TOC_file.append(subdir)
-    return sub_folders_with_TOC_file
+def extract_title_from_TOC_xml(TOC_path):
+    return legacy_toc(TOC_path).title
 
 
-def extract_title_from_TOC_xml(TOC_path):
-    tree = ET.parse(TOC_path)
-    root = tree.getroot()
-    source = {}
-    for s in root.iter('Link'):
-        source = s.attrib
-    if source == {}:
-        title = "unknown title"
-    else:
-        title = (source["SOURCE"])[:-4]
-    return title
-
-
-def get_page_ids_from_document_id(collection_id, document_id, tkbs_client):
-    # This function is slow because it requires downloading the file from Transkribus.
-    # I couldn't find a way to extract the page ids without downloading the file.
-    # If there is such a way - it will surely improve the running speed of the code.
-    now = datetime.now()
-    current_time = now.strftime("%H-%M-%S")
-    temp_folder_name = "temp_folder_for_page_id_" + current_time
-    download(collection_id, document_id, temp_folder_name, tkbs_client)
-    trp_json_path = os.path.join(temp_folder_name, "trp.json")
-    data = read_tkbs_json_file(trp_json_path)
-    p = Document()
-    page_ids = p.load_tkbs_page_ids(data)
-    delete_directory(temp_folder_name)
-    return page_ids
+# page ids from the document metadata, nothing is downloaded, None on error
+# refresh=True reads the document metadata even when the client has the page ids cached, e.g. right after an upload
+def get_page_ids_from_document_id(collection_id, document_id, tkbs_client, refresh=False):
+    try:
+        return tkbs_client.getPageIds(collection_id, document_id, bRefresh=refresh)
+    except Exception as e:
+                print("ERROR in get_page_ids_from_document_id for docid " + str(document_id))
+                print (e)
+                print ("END ERROR \n\n")
+                return None
 
 #check if dir exists, creates it if not
 def prep_dir(out_dir):
@@ -405,9 +372,10 @@ def delete_garbage_text(pgfile, garbage_line_width):
 
 v = False
 def upload_pipeline(config):
-    folders_to_be_uploaded = find_sub_folders_with_toc_file(config.src_path)
+    folders_to_be_uploaded = find_sub_folders_with_toc_file(config.src_path, os.path.join(config.src_path, "legacy_snapshots", "issue_index.json"))
     outfolder = os.path.join(config.src_path, "transkribus_output")
     prep_dir(outfolder)
+    recorder.open(os.path.join(outfolder, "stage_timings.jsonl"))
     legacy_output = os.path.join(config.src_path, "legacy_output")
     collec = config.collection_id
     user = config.username
@@ -417,47 +385,52 @@ def upload_pipeline(config):
     tkbs = TranskribusClient(sServerUrl = "https://transkribus.eu/TrpServer")
     tkbs.auth_login(user, key, True)
 
-    for sfolder in folders_to_be_uploaded:
+    # one issue at a time, its Document is released before the next one
+    def upload_legacy_folder(p, sfolder):
         try:
             if not os.path.isfile(os.path.join(sfolder, 'TOC.xml')):
-                continue
+                return
             infolder = sfolder
             
             start = str(datetime.datetime.now().strftime("%y-%m-%d-%H-%M"))
             print(start + " - " + infolder)
             v and print("---   CREATING DATA to upload  ---")
-            p = Document()
-            p.load_legacy_data(infolder)
+            p.load_legacy_meta(infolder, cachedir=os.path.join(config.src_path, "legacy_snapshots"))
             uniquename = p.doc_title + "_" + start
             firstexportdir = sfolder.replace(config.src_path, legacy_output)
             if not os.path.isdir(firstexportdir):
                 print("Skipping... TKBS output missing under " + firstexportdir + "\nRun stage-1 script  first, to convert legacy to transkribus format.")
-                continue
+                return
             v and print("---   UPLOADING data to server       ---")
             v and print("from " + firstexportdir)
-            docid = upload(collec, firstexportdir, p.img_names_by_pgnum(), p.pxml_names_by_pgnum(), p.title, user, "pipeline test", tkbs)
+            with recorder.stage("upload"):
+                docid = upload(collec, firstexportdir, p.img_names_by_pgnum(), p.pxml_names_by_pgnum(), p.title, user, "pipeline test", tkbs)
             if docid <= 0:
                 print ("ERROR - document failed to upload " + p.title)
-                continue 
+                return 
             
             v and print("---   GETTING page ids       ---")
-            docjson = get_doc(collec, docid, tkbs)
-            pageids = p.load_tkbs_page_ids(docjson)
+            with recorder.stage("get_page_ids"):
+                pageids = get_page_ids_from_document_id(collec, docid, tkbs, refresh=True)
+            if not pageids:
+                print ("ERROR - no page ids for document " + p.title)
+                return
             
             if config.line_detection != None and config.line_detection.upper() == "SKIP":
                 v and print("Skipping from Line Detection and on...")
-                continue
+                return
             
             v and print("---   LINE DETECTION          ---")
-            detection_status = line_detect(collec, docid, pageids, tkbs)
+            with recorder.stage("line_detection", len(pageids)):
+                detection_status = line_detect(collec, docid, pageids, tkbs)
             if not detection_status:
                 print ("ERROR - document failed line detection " + p.title)
-                continue 
+                return 
             
             
             if len(HTRmodelid) < 2:
                 v and print("Skipping from Htr and on...")
-                continue
+                return
                 
             v and print("---   RUNNING OCR          ---")
 #            ocr_status = run_ocr_with_options(collec, HTRmodelid, "", str(446788), {}, tkbs)
@@ -465,14 +438,16 @@ def upload_pipeline(config):
             if config.htr_lang_model != None and config.htr_lang_model:
                 dictionary = "trainDataLanguageModel"
                 v and print("Using trainDataLanguageModel")
-            ocr_status = run_ocr(collec, HTRmodelid, dictionary, str(docid), pageids, tkbs)
+            with recorder.stage("ocr", len(pageids)):
+                ocr_status = run_ocr(collec, HTRmodelid, dictionary, str(docid), pageids, tkbs)
             if not ocr_status:
                 print ("ERROR - document failed ocr " + p.title + " with status " + str(ocr_status))
-                continue 
+                return 
             
             v and print("---   FINAL DOWNLOAD after OCR for TEI export        ---")
             otarget_dir = os.path.join(outfolder, uniquename + "_" + str(collec) + "_" + str(docid))
-            ocrdocjson = download(collec, str(docid), otarget_dir, tkbs, p.tkbs_meta_filename)
+            with recorder.stage("download"):
+                ocrdocjson = download(collec, str(docid), otarget_dir, tkbs, p.tkbs_meta_filename)
             pageids = p.load_tkbs_page_ids(ocrdocjson)
             
             width = config.default_garbage_line_width
@@ -482,20 +457,25 @@ def upload_pipeline(config):
                 width = config.default_garbage_line_width
             if width > 0:
                 v and print("---   DELETING GARBAGE TEXT         ---")
-                for num, fname in p.pxml_names_by_pgnum().items():
-                    fullname = os.path.join(otarget_dir, fname)
-                    delete_garbage_text(fullname, width)
+                with recorder.stage("delete_garbage_text", p.page_count):
+                    for num, fname in p.pxml_names_by_pgnum().items():
+                        fullname = os.path.join(otarget_dir, fname)
+                        delete_garbage_text(fullname, width)
 
             
+        except MemoryError:
+            raise #over the memory budget, reported by process_legacy_issues
         except Exception as e:
             print("ERROR in upload_pipeline main loop ")
             print (e)
             print ("END ERROR \n\n")
             pass
 
+    process_legacy_issues(folders_to_be_uploaded, upload_legacy_folder, config.memory_budget_mb)
 
     print("DONE. Output is under " + outfolder)
     tkbs.auth_logout()
+    tkbs.close()
 
 
 def upload_a_folder(sfolder):
@@ -509,6 +489,7 @@ def upload_a_folder(sfolder):
     OkayMessage = "Done OKAY " + infolder
     ErrorMessage = "Done with ERRORs " + infolder
 
+    recorder.start_issue(infolder)
     try:
         if not os.path.isfile(os.path.join(sfolder, 'TOC.xml')):
             return(ErrorMessage)
@@ -517,28 +498,33 @@ def upload_a_folder(sfolder):
         print(start + " - " + infolder)
         v and print("---   CREATING DATA to upload  ---")
         p = Document()
-        p.load_legacy_data(infolder)
+        p.load_legacy_meta(infolder, cachedir=os.path.join(config.src_path, "legacy_snapshots"))
         uniquename = p.doc_title + "_" + start
         firstexportdir = sfolder.replace(config.src_path, legacy_output)
         if not os.path.isdir(firstexportdir):
             print(p.doc_title + " Skipping... TKBS output missing under " + firstexportdir + "\nRun stage-1 script  first, to convert legacy to transkribus format.")
             return(OkayMessage)
         v and print(p.doc_title + "---   UPLOADING data to server       --- from " + firstexportdir)
-        docid = upload(collec, firstexportdir, p.img_names_by_pgnum(), p.pxml_names_by_pgnum(), p.title, user, "pipeline test", tkbs)
+        with recorder.stage("upload"):
+            docid = upload(collec, firstexportdir, p.img_names_by_pgnum(), p.pxml_names_by_pgnum(), p.title, user, "pipeline test", tkbs)
         if docid <= 0:
             print (p.doc_title + "ERROR - document failed to upload " + p.title)
             return(ErrorMessage) 
         
         v and print(p.doc_title + "---   GETTING page ids       ---")
-        docjson = get_doc(collec, docid, tkbs)
-        pageids = p.load_tkbs_page_ids(docjson)
+        with recorder.stage("get_page_ids"):
+            pageids = get_page_ids_from_document_id(collec, docid, tkbs, refresh=True)
+        if not pageids:
+            print (p.doc_title + "ERROR - no page ids for document " + p.title)
+            return(ErrorMessage)
         
         if config.line_detection != None and config.line_detection.upper() == "SKIP":
             v and print(p.doc_title + "Skipping from Line Detection and on...")
             return(OkayMessage)
         
         v and print(p.doc_title + "---   LINE DETECTION          ---")
-        detection_status = line_detect(collec, docid, pageids, tkbs)
+        with recorder.stage("line_detection", len(pageids)):
+            detection_status = line_detect(collec, docid, pageids, tkbs)
         if not detection_status:
             print (p.doc_title + "ERROR - document failed line detection " + p.title)
             return(ErrorMessage) 
@@ -554,14 +540,16 @@ def upload_a_folder(sfolder):
         if config.htr_lang_model != None and config.htr_lang_model:
             dictionary = "trainDataLanguageModel"
             v and print(p.doc_title + "Using trainDataLanguageModel")
-        ocr_status = run_ocr(collec, HTRmodelid, dictionary, str(docid), pageids, tkbs)
+        with recorder.stage("ocr", len(pageids)):
+            ocr_status = run_ocr(collec, HTRmodelid, dictionary, str(docid), pageids, tkbs)
         if not ocr_status:
             print (p.doc_title + "ERROR - document failed ocr " + p.title + " with status " + str(ocr_status))
             return(ErrorMessage)  
         
         v and print(p.doc_title + "---   FINAL DOWNLOAD after OCR for TEI export        ---")
         otarget_dir = os.path.join(outfolder, uniquename + "_" + str(collec) + "_" + str(docid))
-        ocrdocjson = download(collec, str(docid), otarget_dir, tkbs, p.tkbs_meta_filename)
+        with recorder.stage("download"):
+            ocrdocjson = download(collec, str(docid), otarget_dir, tkbs, p.tkbs_meta_filename)
         pageids = p.load_tkbs_page_ids(ocrdocjson)
         
         width = config.default_garbage_line_width
@@ -571,9 +559,10 @@ def upload_a_folder(sfolder):
             width = config.default_garbage_line_width
         if width > 0:
             v and print(p.doc_title + "---   DELETING GARBAGE TEXT         ---")
-            for num, fname in p.pxml_names_by_pgnum().items():
-                fullname = os.path.join(otarget_dir, fname)
-                delete_garbage_text(fullname, width)
+            with recorder.stage("delete_garbage_text", p.page_count):
+                for num, fname in p.pxml_names_by_pgnum().items():
+                    fullname = os.path.join(otarget_dir, fname)
+                    delete_garbage_text(fullname, width)
                 
         return(OkayMessage)
     except Exception as e:
@@ -581,6 +570,8 @@ def upload_a_folder(sfolder):
         print (e)
         print (p.doc_title + "END ERROR \n\n")
         return(ErrorMessage)
+    finally:
+        recorder.end_issue()
     
     
 def upload_parallel():
@@ -588,7 +579,8 @@ def upload_parallel():
     user = config.username
     key = config.password
     tkbs.auth_login(user, key, True)
-    folders_to_be_uploaded = find_sub_folders_with_toc_file(config.src_path)    
+    recorder.open(os.path.join(config.src_path, tkbs_subfolder, "stage_timings.jsonl"))
+    folders_to_be_uploaded = find_sub_folders_with_toc_file(config.src_path, os.path.join(config.src_path, "legacy_snapshots", "issue_index.json"))
     with ThreadPoolExecutor(max_workers = 3) as executor:
         results = executor.map(upload_a_folder, folders_to_be_uploaded)
     for result in results:
@@ -597,6 +589,7 @@ def upload_parallel():
 
     print("PARALLEL UPLOAD DONE. Output is under " + os.path.join(config.src_path, tkbs_subfolder))
     tkbs.auth_logout()
+    tkbs.close()
 
 
 config = Config(["<user email>", "<user password>", r'<legacy top folder>', \